@@ -0,0 +1,80 @@
+"""
+django_hstore.backends.oids
+
+Caches the OIDs of the hstore types per database, so that registering the
+hstore typecaster on a new connection does not query pg_type each time.
+"""
+import threading
+
+from django.db import connections
+from django.db.models.signals import post_syncdb
+from psycopg2.extras import HstoreAdapter, register_hstore
+
+
+_hstore_oids = {}
+_lock = threading.Lock()
+
+
+def database_key(wrapper):
+    """
+    Identifies the database of a DatabaseWrapper, test databases included.
+    """
+    settings_dict = wrapper.settings_dict
+    return (wrapper.alias, settings_dict['NAME'], settings_dict['HOST'], settings_dict['PORT'])
+
+
+def get_hstore_oids(wrapper):
+    """
+    Returns the (hstore, hstore[]) OIDs of the database of the wrapper, looked
+    up through its connection the first time. Returns None when the database
+    lacks the hstore type, in which case nothing is cached.
+    """
+    key = database_key(wrapper)
+    oids = _hstore_oids.get(key)
+    if oids is None:
+        with _lock:
+            oids = _hstore_oids.get(key)
+            if oids is None:
+                oids = HstoreAdapter.get_oids(wrapper.connection)
+                if not oids or not oids[0]:
+                    return None
+                _hstore_oids[key] = oids
+    return oids
+
+
+def clear_hstore_oids(wrapper=None):
+    """
+    Forgets the OIDs of the database of the wrapper, or of all databases.
+    """
+    if wrapper is None:
+        _hstore_oids.clear()
+    else:
+        _hstore_oids.pop(database_key(wrapper), None)
+
+
+def register_hstore_oids(wrapper):
+    """
+    Registers the hstore typecaster for the connection of the wrapper using
+    the cached OIDs. Registering does not query the database, so OIDs made
+    stale by recreating the extension go unnoticed until cleared, which
+    syncdb and the creation of test databases do. Returns whether the
+    database has the hstore type.
+    """
+    oids = get_hstore_oids(wrapper)
+    if oids is None:
+        return False
+    register_hstore(wrapper.connection, globally=True, unicode=True, oid=oids[0], array_oid=oids[1])
+    return True
+
+
+def refresh_hstore_oids(sender, db=None, **kwargs):
+    """
+    Looks up the OIDs of a database again once syncdb has run on it, as the
+    hstore extension may have been installed or recreated in the meantime.
+    """
+    wrapper = connections[db]
+    clear_hstore_oids(wrapper)
+    if wrapper.connection is not None:
+        register_hstore_oids(wrapper)
+
+post_syncdb.connect(refresh_hstore_oids, dispatch_uid='django_hstore.backends.oids')
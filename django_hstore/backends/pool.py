@@ -0,0 +1,169 @@
+"""
+django_hstore.backends.pool
+
+An opt-in pool of psycopg2 connections for the hstore backends, enabled by a
+POOL entry in the database settings::
+
+    'POOL': {'MAX_SIZE': 10, 'MAX_LIFETIME': 600, 'CHECK': False}
+
+Pooled connections keep their session, so the hstore typecaster and the time
+zone are only set up when a connection is opened.
+"""
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from django_hstore.backends.oids import database_key
+
+
+# connections kept open by a pool unless configured otherwise
+POOL_MAX_SIZE = 10
+
+_pools = {}
+_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of open connections to a database.
+
+    At most max_size idle connections are kept; connections checked out
+    beyond that are closed when released. Connections older than
+    max_lifetime seconds are closed instead of being reused and, when check
+    is set, reused connections are probed with a query first.
+    """
+    def __init__(self, max_size=POOL_MAX_SIZE, max_lifetime=None, check=False):
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.check = check
+        self._idle = []
+        self._opened = {}
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'reused': 0, 'released': 0, 'discarded': 0}
+
+    def checkout(self):
+        """
+        Returns an idle healthy connection, or None when a new one has to be
+        opened and then handed to opened().
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection = self._idle.pop()
+            if self._expired(connection) or not self._healthy(connection):
+                self._discard(connection)
+                continue
+            with self._lock:
+                self._stats['reused'] += 1
+            return connection
+
+    def opened(self, connection):
+        """
+        Records a connection opened for the pool.
+        """
+        with self._lock:
+            self._opened[connection] = time.time()
+            self._stats['opened'] += 1
+
+    def release(self, connection):
+        """
+        Takes a connection back, rolling back its pending transaction, or
+        closes it when it is broken, expired or in excess.
+        """
+        try:
+            if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            self._discard(connection)
+            return
+        with self._lock:
+            if connection.closed or connection not in self._opened or len(self._idle) >= self.max_size:
+                keep = False
+            else:
+                keep = not self._expired(connection)
+            if keep:
+                self._idle.append(connection)
+                self._stats['released'] += 1
+        if not keep:
+            self._discard(connection)
+
+    def close_all(self):
+        """
+        Closes the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self):
+        """
+        Returns the number of idle and checked out connections along with the
+        counts of connections opened, reused, released and discarded.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._opened) - len(self._idle)
+        return stats
+
+    def _expired(self, connection):
+        if self.max_lifetime is None:
+            return False
+        return time.time() - self._opened.get(connection, 0) > self.max_lifetime
+
+    def _healthy(self, connection):
+        if connection.closed:
+            return False
+        if not self.check:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, connection):
+        with self._lock:
+            self._opened.pop(connection, None)
+            self._stats['discarded'] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+def get_pool(wrapper):
+    """
+    Returns the pool of the database of a DatabaseWrapper, or None when its
+    settings do not enable pooling.
+    """
+    options = wrapper.settings_dict.get('POOL')
+    if not options:
+        return None
+    key = database_key(wrapper)
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                options = options if isinstance(options, dict) else {}
+                pool = _pools[key] = ConnectionPool(
+                    max_size=options.get('MAX_SIZE', POOL_MAX_SIZE),
+                    max_lifetime=options.get('MAX_LIFETIME'),
+                    check=options.get('CHECK', False),
+                )
+    return pool
+
+
+def pool_stats():
+    """
+    Returns the statistics of every pool, by (alias, name, host, port).
+    """
+    return dict((key, pool.stats()) for key, pool in _pools.items())
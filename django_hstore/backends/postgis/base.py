@@ -7,7 +7,9 @@ from django import VERSION
 from django.conf import settings
 from django.contrib.gis.db.backends.postgis.base import DatabaseWrapper, PostGISCreation
 from django.db.backends.util import truncate_name
-from psycopg2.extras import register_hstore
+
+from django_hstore.backends.oids import clear_hstore_oids, register_hstore_oids
+from django_hstore.backends.pool import get_pool
 
 try:
     from django.db.backends.postgresql_psycopg2.version import get_version
@@ -54,10 +56,20 @@ class DatabaseCreation(PostGISCreation):
     def _create_test_db(self, verbosity, autoclobber):
         test_database_name = super(DatabaseCreation, self)._create_test_db(verbosity, autoclobber)
         self.install_hstore_contrib(test_database_name)
-        register_hstore(self.connection.connection, globally=True, unicode=True)
+        clear_hstore_oids(self.connection)
+        register_hstore_oids(self.connection)
         
         return test_database_name
 
+    def destroy_test_db(self, old_database_name, verbosity=1):
+        # close the pooled connections to the test database, which could
+        # not be dropped while they are open
+        self.connection.close()
+        pool = self.connection.pool
+        if pool is not None:
+            pool.close_all()
+        super(DatabaseCreation, self).destroy_test_db(old_database_name, verbosity)
+
     def install_hstore_contrib(self, test_database_name):
         # point to test database
         self.connection.close()
@@ -110,25 +122,32 @@ class DatabaseCreation(PostGISCreation):
     def sql_indexes_for_field(self, model, f, style):
         kwargs = VERSION[:2] >= (1, 3) and {'connection': self.connection} or {}
         if f.db_type(**kwargs) == 'hstore':
-            if not f.db_index:
-                return []
-            # create GIST index for hstore column
-            qn = self.connection.ops.quote_name
-            index_name = '%s_%s_gist' % (model._meta.db_table, f.column)
-            clauses = [style.SQL_KEYWORD('CREATE INDEX'),
-                       style.SQL_TABLE(qn(truncate_name(index_name, self.connection.ops.max_name_length()))),
-                       style.SQL_KEYWORD('ON'),
-                       style.SQL_TABLE(qn(model._meta.db_table)),
-                       style.SQL_KEYWORD('USING GIST'),
-                       '(%s)' % style.SQL_FIELD(qn(f.column))]
-            # add tablespace clause
-            tablespace = f.db_tablespace or model._meta.db_tablespace
-            if tablespace:
-                sql = self.connection.ops.tablespace_sql(tablespace)
-                if sql:
-                    clauses.append(sql)
-            clauses.append(';')
-            return [' '.join(clauses)]
+            output = []
+            index_type = getattr(f, 'index_type', 'gist')
+            if f.db_index and index_type:
+                # create GIST or GIN index for hstore column
+                qn = self.connection.ops.quote_name
+                index_name = '%s_%s_%s' % (model._meta.db_table, f.column, index_type)
+                opclass = getattr(f, 'index_opclass', None)
+                clauses = [style.SQL_KEYWORD('CREATE INDEX'),
+                           style.SQL_TABLE(qn(truncate_name(index_name, self.connection.ops.max_name_length()))),
+                           style.SQL_KEYWORD('ON'),
+                           style.SQL_TABLE(qn(model._meta.db_table)),
+                           style.SQL_KEYWORD('USING %s' % index_type.upper()),
+                           '(%s%s)' % (style.SQL_FIELD(qn(f.column)), opclass and ' %s' % opclass or '')]
+                # add tablespace clause
+                tablespace = f.db_tablespace or model._meta.db_tablespace
+                if tablespace:
+                    sql = self.connection.ops.tablespace_sql(tablespace)
+                    if sql:
+                        clauses.append(sql)
+                clauses.append(';')
+                output.append(' '.join(clauses))
+            # create expression indexes for the hot keys
+            from django_hstore.query import key_index_sql
+            for key, cast in getattr(f, 'indexed_keys', ()):
+                output.append(key_index_sql(model, f.name, key, cast == 'numeric', self.connection))
+            return output
         return super(DatabaseCreation, self).sql_indexes_for_field(model, f, style)
 
 
@@ -141,13 +160,34 @@ class DatabaseWrapper(DatabaseWrapper):
         super(DatabaseWrapper, self).__init__(*args, **params)
         self.creation = DatabaseCreation(self)
 
+    @property
+    def pool(self):
+        return get_pool(self)
+
     def _cursor(self):
+        pool = self.pool
+        if self.connection is None and pool is not None:
+            # reuse a pooled connection, already set up
+            self.connection = pool.checkout()
+            if self.connection is not None:
+                self.connection.set_isolation_level(self.isolation_level)
+        connecting = self.connection is None
         # ensure that we're connected
         cursor = super(DatabaseWrapper, self)._cursor()
 
-        # register hstore extension
-        register_hstore(self.connection, globally=True, unicode=True)
-
-        # bypass future registrations
-        self._cursor = super(DatabaseWrapper, self)._cursor
+        # register hstore extension on new connections, from the cached OIDs
+        if connecting:
+            register_hstore_oids(self)
+            if pool is not None:
+                pool.opened(self.connection)
         return cursor
+
+    def close(self):
+        pool = self.pool
+        if self.connection is not None and pool is not None:
+            self.validate_thread_sharing()
+            # hand the connection back to the pool instead of closing it
+            connection, self.connection = self.connection, None
+            pool.release(connection)
+        else:
+            super(DatabaseWrapper, self).close()
@@ -0,0 +1,84 @@
+"""
+django_hstore.codec
+
+Codecs translate the values of a DictionaryField to and from the strings
+stored in hstore.
+"""
+from django_hstore import util
+
+
+class Codec(object):
+    """
+    Base codec. Subclasses implement encode() and decode() for single values
+    and may override the dictionary methods when they can do better in bulk.
+    """
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, value):
+        raise NotImplementedError
+
+    def encode_dict(self, d):
+        return dict((key, self.encode(value)) for key, value in d.iteritems())
+
+    def decode_dict(self, d):
+        return dict((key, self.decode(value)) for key, value in d.iteritems())
+
+
+class JSONCodec(Codec):
+    """
+    Stores every value as JSON, restoring numbers, lists, dictionaries and
+    dates on the way back. Strings which cannot be JSON are returned as is.
+    """
+    def encode(self, value):
+        return util.json_serialize_value(value)
+
+    def decode(self, value):
+        if not isinstance(value, basestring):
+            return value
+        return util.json_unserialize_value(value)
+
+    def encode_dict(self, d):
+        return util.json_serialize_dict(d)
+
+    def decode_dict(self, d):
+        return util.json_unserialize_dict(d)
+
+
+class RawCodec(Codec):
+    """
+    Leaves the strings stored in hstore untouched. Values which are not
+    strings are encoded to JSON when saved but never decoded.
+    """
+    def encode(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        return util.json_serialize_value(value)
+
+    def decode(self, value):
+        return value
+
+    def decode_dict(self, d):
+        return d
+
+
+CODECS = {
+    'json': JSONCodec,
+    'raw': RawCodec,
+}
+
+
+def get_codec(codec):
+    """
+    Returns a codec instance given its name, class or an instance.
+    """
+    if isinstance(codec, basestring):
+        try:
+            codec = CODECS[codec]
+        except KeyError:
+            raise ValueError('unknown codec: %s' % codec)
+    if isinstance(codec, type):
+        codec = codec()
+    if not isinstance(codec, Codec):
+        raise ValueError('invalid codec: %r' % (codec,))
+    return codec
@@ -2,24 +2,173 @@ from django.db import models, connection
 from django.utils.translation import ugettext_lazy as _
 
 from django_hstore import forms, util
+from django_hstore.codec import get_codec
+
+
+def decoding(name):
+    """
+    Wraps a dict method so that pending values are decoded before it runs.
+    """
+    method = getattr(dict, name)
+
+    def decoder(self, *args, **kwargs):
+        self.decode()
+        return method(self, *args, **kwargs)
+    decoder.__name__ = name
+    return decoder
 
 
 class HStoreDictionary(dict):
     """
     A dictionary subclass which implements hstore support.
+
+    In lazy mode the dictionary holds the values as stored in hstore and
+    decodes each one through the field on first access. Copies made at the
+    C level, dict(d) and **d, see the pending strings: use d.copy() or call
+    d.decode() first.
     """
-    def __init__(self, value=None, field=None, instance=None, **params):
+    def __init__(self, value=None, field=None, instance=None, lazy=False, **params):
         super(HStoreDictionary, self).__init__(value, **params)
         self.field = field
         self.instance = instance
+        # keys whose values have not been decoded yet
+        self._encoded = set(dict.__iter__(self)) if lazy else None
+        # keys set and deleted since loaded, written by save_changes()
+        self._changed = set()
+        self._removed = set()
+
+    def _decode_key(self, key):
+        if self._encoded and key in self._encoded:
+            self._encoded.discard(key)
+            value = self.field._value_to_python(dict.__getitem__(self, key))
+            dict.__setitem__(self, key, value)
+
+    def _mark_changed(self, key):
+        if self._encoded:
+            self._encoded.discard(key)
+        self._changed.add(key)
+        self._removed.discard(key)
+
+    def _mark_removed(self, key):
+        if self._encoded:
+            self._encoded.discard(key)
+        self._changed.discard(key)
+        self._removed.add(key)
+
+    def __reduce__(self):
+        # the items are restored through __init__, before the tracking state
+        self.decode()
+        return (self.__class__, (dict(self),), self.__dict__.copy())
+
+    def decode(self):
+        """
+        Decodes all the values which are still pending.
+        """
+        if self._encoded:
+            for key in list(self._encoded):
+                self._decode_key(key)
+
+    def __getitem__(self, key):
+        self._decode_key(key)
+        return super(HStoreDictionary, self).__getitem__(key)
 
-    def remove(self, keys):
+    def __setitem__(self, key, value):
+        self._mark_changed(key)
+        super(HStoreDictionary, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(HStoreDictionary, self).__delitem__(key)
+        self._mark_removed(key)
+
+    def get(self, key, default=None):
+        self._decode_key(key)
+        return super(HStoreDictionary, self).get(key, default)
+
+    def pop(self, key, *args):
+        self._decode_key(key)
+        if key in self:
+            self._mark_removed(key)
+        return super(HStoreDictionary, self).pop(key, *args)
+
+    def popitem(self):
+        self.decode()
+        key, value = super(HStoreDictionary, self).popitem()
+        self._mark_removed(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        self._decode_key(key)
+        if key not in self:
+            self._mark_changed(key)
+        return super(HStoreDictionary, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        updates = dict(*args, **kwargs)
+        for key in updates:
+            self._mark_changed(key)
+        super(HStoreDictionary, self).update(updates)
+
+    def clear(self):
+        for key in self.keys():
+            self._mark_removed(key)
+        self._encoded = None
+        super(HStoreDictionary, self).clear()
+
+    values = decoding('values')
+    items = decoding('items')
+    itervalues = decoding('itervalues')
+    iteritems = decoding('iteritems')
+    copy = decoding('copy')
+    __repr__ = decoding('__repr__')
+
+    def __eq__(self, other):
+        self.decode()
+        if isinstance(other, HStoreDictionary):
+            other.decode()
+        return super(HStoreDictionary, self).__eq__(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def remove(self, keys, queue=None):
         """
-        Removes the specified keys from this dictionary.
+        Removes the specified keys from this dictionary. Given a RemovalQueue
+        the removal is only queued, to be flushed together with others.
         """
+        if queue is not None:
+            queue.add(self.instance, self.field.name, keys)
+            return
         queryset = self.instance._base_manager.get_query_set()
         queryset.filter(pk=self.instance.pk).hremove(self.field.name, keys)
 
+    def has_changes(self):
+        return bool(self._changed or self._removed)
+
+    def reset_changes(self):
+        """
+        Forgets the keys set and deleted so far, once the whole dictionary has
+        been written.
+        """
+        self._changed.clear()
+        self._removed.clear()
+
+    def save_changes(self):
+        """
+        Writes the keys set and deleted since this dictionary was loaded with a
+        single update, leaving the other stored keys untouched. Returns the
+        number of updated rows.
+        """
+        if not self.has_changes():
+            return 0
+        updates = dict((key, dict.__getitem__(self, key)) for key in self._changed)
+        queryset = self.instance._base_manager.get_query_set()
+        rows = queryset.filter(pk=self.instance.pk).hdelta(self.field.name, updates, self._removed)
+        self.reset_changes()
+        return rows
+
 
 class HStoreReferenceDictionary(HStoreDictionary):
     """
@@ -30,7 +179,7 @@ class HStoreReferenceDictionary(HStoreDictionary):
         # if value is a string it needs to be converted to model instance
         if isinstance(value, basestring):
             reference = util.acquire_reference(value)
-            self.__setitem__(args[0], reference)
+            dict.__setitem__(self, args[0], reference)
             return reference
         # otherwise just return the relation
         return value
@@ -41,14 +190,30 @@ class HStoreReferenceDictionary(HStoreDictionary):
         except KeyError:
             return default
 
+    def populate(self, references):
+        """
+        Replaces unresolved references with instances from the given mapping.
+        """
+        for key, value in self.items():
+            if isinstance(value, basestring) and value in references:
+                dict.__setitem__(self, key, references[value])
+
 
 class HStoreDescriptor(models.fields.subclassing.Creator):
     def __set__(self, obj, value):
-        value = self.field.to_python(value)
-        if isinstance(value, dict):
+        if getattr(self.field, 'lazy', False) and isinstance(value, dict):
+            # keep the stored strings, they are decoded on first access
+            if isinstance(value, HStoreDictionary):
+                value.decode()
             value = HStoreDictionary(
-                value=value, field=self.field, instance=obj
+                value=value, field=self.field, instance=obj, lazy=True
             )
+        else:
+            value = self.field.to_python(value)
+            if isinstance(value, dict):
+                value = HStoreDictionary(
+                    value=value, field=self.field, instance=obj
+                )
         obj.__dict__[self.field.name] = value
 
 
@@ -65,12 +230,38 @@ class HStoreReferenceDescriptor(models.fields.subclassing.Creator):
 class HStoreField(models.Field):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('db_index', True)
+        # keys filtered on often enough to deserve their own B-tree index,
+        # either names or (name, 'numeric') pairs for numeric comparisons
+        self.indexed_keys = []
+        for key in kwargs.pop('indexed_keys', ()):
+            key, cast = (key, None) if isinstance(key, basestring) else key
+            if cast not in (None, 'text', 'numeric'):
+                raise ValueError('invalid cast for key %s: %s' % (key, cast))
+            self.indexed_keys.append((key, cast if cast == 'numeric' else None))
+        self.key_casts = dict(self.indexed_keys)
+        # access method and operator class of the index over the whole column
+        self.index_type = kwargs.pop('index_type', 'gist')
+        if self.index_type == 'none':
+            self.index_type = None
+        if self.index_type not in ('gist', 'gin', None):
+            raise ValueError('invalid index type: %s' % self.index_type)
+        self.index_opclass = kwargs.pop('index_opclass', None)
+        # seconds during which the distinct keys of the table are cached
+        self.key_catalog_timeout = kwargs.pop('key_catalog_timeout', None)
         super(HStoreField, self).__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name):
         super(HStoreField, self).contribute_to_class(cls, name)
         setattr(cls, self.name, HStoreDescriptor(self))
 
+    def pre_save(self, model_instance, add):
+        value = super(HStoreField, self).pre_save(model_instance, add)
+        if isinstance(value, HStoreDictionary):
+            # the whole dictionary is written, so save_changes() must not
+            # send its keys again over later concurrent writes
+            value.reset_changes()
+        return value
+
     def get_default(self):
         """
         Returns the default value for this field.
@@ -89,6 +280,12 @@ class HStoreField(models.Field):
             return None
         return {}
 
+    def get_prep_lookup(self, lookup_type, value):
+        if lookup_type in ('has_key', 'has_any_keys', 'has_all_keys', 'not_contains'):
+            # prepared as contains, its complement
+            return value
+        return super(HStoreField, self).get_prep_lookup(lookup_type, value)
+
     def value_to_string(self, obj):
         return self._get_val_from_obj(obj)
 
@@ -105,22 +302,30 @@ class HStoreField(models.Field):
 class DictionaryField(HStoreField):
     description = _("A python dictionary in a postgresql hstore field.")
 
+    def __init__(self, *args, **kwargs):
+        self.codec = get_codec(kwargs.pop('codec', 'json'))
+        self.lazy = kwargs.pop('lazy', False)
+        super(DictionaryField, self).__init__(*args, **kwargs)
+
     def formfield(self, **params):
         params['form_class'] = forms.DictionaryField
         return super(DictionaryField, self).formfield(**params)
 
     def _value_to_python(self, value):
-        return value
+        return self.codec.decode(value)
 
     def get_prep_value(self, value):
+        if hasattr(value, 'as_sql'):
+            # hstore expressions of the update methods
+            return value
         if value:
-            value = util.json_serialize_dict(value)
+            value = self.codec.encode_dict(value)
         return super(DictionaryField, self).get_prep_value(value)
 
     def to_python(self, value):
         value = super(DictionaryField, self).to_python(value)
         if value:
-            return util.json_unserialize_dict(value)
+            return self.codec.decode_dict(value)
         else:
             return {}
 
@@ -142,6 +347,8 @@ class ReferencesField(HStoreField):
         return value
 
     def get_prep_value(self, value):
+        if hasattr(value, 'as_sql'):
+            return value
         return util.serialize_references(value)
 
     def to_python(self, value):
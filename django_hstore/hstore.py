@@ -1,5 +1,6 @@
 from django_hstore.fields import DictionaryField, ReferencesField
 from django_hstore.managers import HStoreManager
+from django_hstore.query import HStoreBatch, RemovalQueue
 
 try: 
 	from django_hstore.managers import HStoreGeoManager
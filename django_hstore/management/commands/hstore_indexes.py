@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import get_models
+
+from django_hstore.fields import HStoreField
+
+
+# GIST and GIN indexes covering a column
+INDEXES_SQL = """
+SELECT i.relname, am.amname
+FROM pg_index x
+JOIN pg_class i ON i.oid = x.indexrelid
+JOIN pg_class t ON t.oid = x.indrelid
+JOIN pg_am am ON am.oid = i.relam
+JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(x.indkey)
+WHERE t.relname = %s AND a.attname = %s AND am.amname IN ('gist', 'gin')
+ORDER BY i.relname
+"""
+
+
+class Command(BaseCommand):
+    help = 'Reports hstore column indexes which do not match the declared index_type and optionally rebuilds them.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Drop mismatching indexes and create the declared ones.'),
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        rebuild = options.get('rebuild')
+        connection = connections[using]
+        cursor = connection.cursor()
+        for model in get_models():
+            for field in model._meta.local_fields:
+                if not isinstance(field, HStoreField):
+                    continue
+                declared = field.db_index and field.index_type or None
+                cursor.execute(INDEXES_SQL, [model._meta.db_table, field.column])
+                existing = cursor.fetchall()
+                matching = [name for name, method in existing if method == declared]
+                stale = [name for name, method in existing if method != declared]
+                status = (not stale and bool(matching) == bool(declared)) and 'ok' or 'mismatch'
+                self.stdout.write('%s.%s: declared %s, found %s, %s\n' % (
+                    model._meta.db_table, field.column, declared or 'none',
+                    ', '.join('%s (%s)' % index for index in existing) or 'none', status))
+                if not rebuild or status == 'ok':
+                    continue
+                qn = connection.ops.quote_name
+                for name in stale:
+                    cursor.execute('DROP INDEX %s' % qn(name))
+                    self.stdout.write('  dropped %s\n' % name)
+                if declared and not matching:
+                    sql = connection.creation.sql_indexes_for_field(model, field, no_style())[0]
+                    cursor.execute(sql)
+                    self.stdout.write('  created %s\n' % sql)
+                transaction.commit_unless_managed(using=using)
@@ -26,6 +26,63 @@ class HStoreManager(models.Manager):
     def hslice(self, attr, keys, **params):
         return self.filter(**params).hslice(attr, keys)
 
+    def hpeek_values(self, attr, key, chunk_size=None, **params):
+        return self.filter(**params).hpeek_values(attr, key, chunk_size)
+
+    def hslice_values(self, attr, keys, chunk_size=None, **params):
+        return self.filter(**params).hslice_values(attr, keys, chunk_size)
+
+    def stream(self, chunk_size=None, raw=False, **params):
+        return self.filter(**params).stream(chunk_size, raw)
+
+    def copy_to(self, fileobj, format='csv', keys=None, attr=None, **params):
+        return self.filter(**params).copy_to(fileobj, format, keys, attr)
+
+    def annotate_keys(self, **aliases):
+        return self.get_query_set().annotate_keys(**aliases)
+
+    def hvalues(self, attr, keys, *fields):
+        return self.get_query_set().hvalues(attr, keys, *fields)
+
+    def hdicts(self, attr, decode=True, **params):
+        return self.filter(**params).hdicts(attr, decode)
+
+    def hkeys_distinct(self, attr, sample=None, **params):
+        return self.filter(**params).hkeys_distinct(attr, sample)
+
+    def hkey_counts(self, attr, **params):
+        return self.filter(**params).hkey_counts(attr)
+
+    def hvalue_counts(self, attr, key, **params):
+        return self.filter(**params).hvalue_counts(attr, key)
+
+    def hsum(self, attr, key, **params):
+        return self.filter(**params).hsum(attr, key)
+
+    def havg(self, attr, key, **params):
+        return self.filter(**params).havg(attr, key)
+
+    def hmin(self, attr, key, **params):
+        return self.filter(**params).hmin(attr, key)
+
+    def hmax(self, attr, key, **params):
+        return self.filter(**params).hmax(attr, key)
+
+    def bulk_hupdate(self, attr, updates, batch_size=None):
+        return self.get_query_set().bulk_hupdate(attr, updates, batch_size)
+
+    def bulk_hremove(self, attr, removals, batch_size=None):
+        return self.get_query_set().bulk_hremove(attr, removals, batch_size)
+
+    def copy_from(self, rows, fields=None, chunk_size=None):
+        return self.get_query_set().copy_from(rows, fields, chunk_size)
+
+    def hupsert(self, lookup, attr, updates, defaults=None, batch_size=None):
+        return self.get_query_set().hupsert(lookup, attr, updates, defaults, batch_size)
+
+    def prefetch_references(self, *attrs):
+        return self.get_query_set().prefetch_references(*attrs)
+
     def filter(self, *args, **kwargs):
         kwargs = util.serialize_queryset_arguments(self.hstore_fieldnames, **kwargs)
         return super(HStoreManager, self).filter(*args, **kwargs)
@@ -1,17 +1,40 @@
+import re
+import threading
+import time
+import uuid
+from cStringIO import StringIO
+from decimal import Decimal
+
 from django import VERSION
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import AutoField
 from django.db.models.query import QuerySet
-from django.db.models.sql.constants import SINGLE
+from django.db.models.sql.constants import QUERY_TERMS, SINGLE
 from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.sql.query import Query
 from django.db.models.sql.subqueries import UpdateQuery
 from django.db.models.sql.where import EmptyShortCircuit, WhereNode
+from django.utils.datastructures import SortedDict
 
 try:
     from django.db.models.sql.where import QueryWrapper  # django <= 1.3
 except ImportError:
     from django.db.models.query_utils import QueryWrapper  # django >= 1.4
 
+from django_hstore import util
+from django_hstore.fields import HStoreField, ReferencesField
+
+
+# number of rows updated by a single statement of the bulk operations
+BULK_BATCH_SIZE = 1000
+# number of rows fetched at a time from server side cursors
+STREAM_CHUNK_SIZE = 2000
+# number of instances whose references are resolved together
+PREFETCH_CHUNK_SIZE = 1000
+# number of rows loaded by a single COPY statement
+COPY_CHUNK_SIZE = 5000
+
 
 class literal_clause(object):
     def __init__(self, sql, params):
@@ -32,79 +55,318 @@ def select_query(method):
     return selector
 
 
-def update_query(method):
+def managed_write(using, execute):
+    """
+    Calls execute() under transaction management and commits its changes.
+    """
+    forced_managed = False
+    if not transaction.is_managed(using=using):
+        transaction.enter_transaction_management(using=using)
+        forced_managed = True
+    try:
+        result = execute()
+        if forced_managed:
+            transaction.commit(using=using)
+        else:
+            transaction.commit_unless_managed(using=using)
+    finally:
+        if forced_managed:
+            transaction.leave_transaction_management(using=using)
+    return result
+
 
+def update_query(method):
+    """
+    Decorates methods returning an (attr, updates, keys) delta, which is
+    applied to the matched rows or deferred to the active HStoreBatch.
+    """
     def updater(self, *args, **params):
         self._for_write = True
-        query = method(self, self.query.clone(UpdateQuery), *args, **params)
-        forced_managed = False
-        if not transaction.is_managed(using=self.db):
-            transaction.enter_transaction_management(using=self.db)
-            forced_managed = True
-        try:
-            rows = query.get_compiler(self.db).execute_sql(None)
-            if forced_managed:
-                transaction.commit(using=self.db)
-            else:
-                transaction.commit_unless_managed(using=self.db)
-        finally:
-            if forced_managed:
-                transaction.leave_transaction_management(using=self.db)
+        attr, updates, keys = method(self, *args, **params)
+        batch = HStoreBatch.current(self.db)
+        if batch is not None:
+            return batch.defer(self, attr, updates, keys)
+        query = self.query.clone(UpdateQuery)
+        field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
+        value = QueryWrapper(*hstore_delta('"%s"' % attr, [], updates, keys))
+        query.add_update_fields([(field, None, value)])
+        rows = managed_write(self.db, lambda: query.get_compiler(self.db).execute_sql(None))
         self._result_cache = None
         return rows
     updater.alters_data = True
     return updater
 
 
+def server_side_rows(using, sql, params, chunk_size=None):
+    """
+    Yields the rows of a query from a named, server side, cursor which
+    fetches chunk_size rows at a time.
+    """
+    connection = connections[using]
+    # make sure the connection is open
+    connection.cursor()
+    cursor = connection.connection.cursor(name='django_hstore_%s' % uuid.uuid4().hex)
+    cursor.itersize = chunk_size or STREAM_CHUNK_SIZE
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def hstore_delta(sql, params, updates=None, keys=None):
+    """
+    Wraps an hstore expression so that it removes the given keys and then
+    merges the given updates, returning the new SQL and params.
+    """
+    params = list(params)
+    if isinstance(keys, basestring):
+        keys = [keys]
+    if keys:
+        sql = 'delete(%s, %%s)' % sql
+        params.append(list(keys))
+    if updates:
+        sql = '%s || %%s' % sql
+        params.append(updates)
+    return sql, params
+
+
+# lookups added for hstore fields
+HSTORE_TERMS = ('has_key', 'has_any_keys', 'has_all_keys', 'not_contains')
+
+# matches the numbers stored in hstore, used to guard the numeric casts
+NUMBER = re.compile(r'^-?[0-9]+([.][0-9]+)?([eE][-+]?[0-9]+)?$')
+NUMBER_SQL = "'^-?[0-9]+([.][0-9]+)?([eE][-+]?[0-9]+)?$'"
+
+
+def key_sql(column, key):
+    """
+    Returns the SQL expression of the value of an hstore key.
+    """
+    return "%s->'%s'" % (column, key.replace("'", "''"))
+
+
+def quote_key(key):
+    """
+    Quotes an hstore key as an SQL identifier. Unlike quote_name() embedded
+    double quotes are escaped, keys being arbitrary strings.
+    """
+    return '"%s"' % key.replace('"', '""')
+
+
+def numeric_key_sql(column, key):
+    """
+    Returns the SQL expression of the value of an hstore key cast to numeric,
+    which is NULL when the value is not a number.
+    """
+    value = key_sql(column, key)
+    return '(CASE WHEN %s ~ %s THEN (%s)::numeric END)' % (value, NUMBER_SQL, value)
+
+
+def is_number(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, long, float, Decimal)):
+        return True
+    return isinstance(value, basestring) and NUMBER.match(value) is not None
+
+
+def key_index_sql(model, attr, key, numeric=False, connection=None):
+    """
+    Returns the statement creating a B-tree index on the value of an hstore
+    key, matching the expression used by lookups on that key. Numeric indexes
+    serve gt, gte, lt and lte lookups with numbers.
+    """
+    connection = connection or connections[model.objects.db]
+    qn = connection.ops.quote_name
+    column = qn(model._meta.get_field_by_name(attr)[0].column)
+    expression = (numeric and numeric_key_sql or key_sql)(column, key)
+    index_name = '%s_%s_%s%s' % (model._meta.db_table, attr, re.sub(r'\W', '_', key), numeric and '_num' or '')
+    index_name = truncate_name(index_name, connection.ops.max_name_length())
+    return 'CREATE INDEX %s ON %s ((%s));' % (qn(index_name), qn(model._meta.db_table), expression)
+
+
+def is_hstore_field(field, connection):
+    """
+    Tells whether a field is stored in an hstore column, caching the answer.
+    """
+    key = (id(field), connection.alias)
+    try:
+        return _hstore_fields[key]
+    except KeyError:
+        kwargs = {'connection': connection} if VERSION[:2] >= (1, 3) else {}
+        _hstore_fields[key] = hasattr(field, 'db_type') and field.db_type(**kwargs) == 'hstore'
+        return _hstore_fields[key]
+
+_hstore_fields = {}
+
+
+def atom_shape(lookup_type, param):
+    """
+    Returns what the SQL of an hstore lookup depends on besides the column.
+    """
+    if isinstance(param, dict):
+        if lookup_type in ('gt', 'gte', 'lt', 'lte'):
+            return tuple((key, is_number(value)) for key, value in param.iteritems())
+        if lookup_type in ('contains', 'icontains'):
+            return tuple(sorted((key, isinstance(value, (list, tuple))) for key, value in param.iteritems()))
+        return dict
+    if isinstance(param, (list, tuple)):
+        return (list, min(len(param), 2))
+    return type(param)
+
+
+def compile_atom(field, lookup_type, param, key_casts):
+    """
+    Compiles an hstore lookup to its SQL, which only depends on the shape of
+    the value, and a function building the params from the value. Returns
+    None for the lookups left to the default text handling.
+    """
+    if lookup_type == 'exact':
+        if isinstance(param, dict):
+            return ('%s = %%s' % field, lambda param: [param])
+        else:
+            raise ValueError('invalid value')
+
+    elif lookup_type in ('gt', 'gte', 'lt', 'lte'):
+        if isinstance(param, dict) and len(param) == 1:
+            sign = (lookup_type[0] == 'g' and '>%s' or '<%s') % (
+                lookup_type[-1] == 'e' and '=' or '')
+            key, value = param.items()[0]
+            if is_number(value):
+                # compare numbers as such rather than as text
+                return ('%s %s %%s' % (numeric_key_sql(field, key), sign),
+                        lambda param: [Decimal(str(param.values()[0]))])
+            elif key_casts.get(key) == 'numeric':
+                raise ValueError('invalid value')
+            return ('%s %s %%s' % (key_sql(field, key), sign), lambda param: param.values())
+        else:
+            raise ValueError('invalid value')
+
+    elif lookup_type in ['contains', 'icontains']:
+        if isinstance(param, dict):
+            sql, parts, subset = [], [], []
+            for key, value in sorted(param.iteritems()):
+                if isinstance(value, (list, tuple)):
+                    # any of the listed values
+                    sql.append('%s = ANY(%%s)' % key_sql(field, key))
+                    parts.append((key, True))
+                elif key in key_casts and key_casts[key] is None:
+                    # match the expression index of the key
+                    sql.append('%s = %%s' % key_sql(field, key))
+                    parts.append((key, False))
+                else:
+                    subset.append(key)
+            with_subset = bool(subset or not sql)
+            if with_subset:
+                sql.append('%s @> %%s' % field)
+
+            def build(param):
+                params = [map(str, param[key]) if listed else param[key] for key, listed in parts]
+                if with_subset:
+                    params.append(dict((key, param[key]) for key in subset))
+                return params
+            return (len(sql) == 1 and sql[0] or '(%s)' % ' AND '.join(sql), build)
+        elif isinstance(param, (list, tuple)) and param:
+            if len(param) < 2:
+                return ('%s ? %%s' % field, lambda param: [param[0]])
+            return ('%s ?& %%s' % field, lambda param: [param])
+        elif isinstance(param, basestring):
+            # if looking for a string perform the normal text lookup
+            # that is: look for occurence of string in all the keys
+            return None
+        else:
+            raise ValueError('invalid value')
+
+    elif lookup_type == 'has_key':
+        if isinstance(param, basestring):
+            return ('%s ? %%s' % field, lambda param: [param])
+        else:
+            raise ValueError('invalid value')
+
+    elif lookup_type in ('has_any_keys', 'has_all_keys'):
+        if param:
+            operator = lookup_type == 'has_any_keys' and '?|' or '?&'
+            return ('%s %s %%s' % (field, operator),
+                    lambda param: [[param] if isinstance(param, basestring) else list(param)])
+        else:
+            raise ValueError('invalid value')
+
+    elif lookup_type == 'not_contains':
+        if isinstance(param, dict):
+            return ('NOT (%s @> %%s)' % field, lambda param: [param])
+        elif isinstance(param, basestring):
+            return ('NOT (%s ? %%s)' % field, lambda param: [param])
+        elif isinstance(param, (list, tuple)) and param:
+            return ('NOT (%s ?& %%s)' % field, lambda param: [list(param)])
+        else:
+            raise ValueError('invalid value')
+
+    else:
+        raise TypeError('invalid lookup type')
+
+
+# upper bound of the compiled atoms cache, it is emptied once it is reached
+ATOM_CACHE_SIZE = 1024
+
+_atom_cache = {}
+_atom_stats = {'hits': 0, 'misses': 0}
+
+
+def atom_cache_info():
+    """
+    Returns the hits, misses, size and hit rate of the compiled atoms cache.
+    """
+    hits, misses = _atom_stats['hits'], _atom_stats['misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'size': len(_atom_cache),
+        'hit_rate': hits and float(hits) / (hits + misses) or 0.0,
+    }
+
+
+def clear_atom_cache():
+    _atom_cache.clear()
+    _atom_stats['hits'] = _atom_stats['misses'] = 0
+
+
+# distinct keys of whole tables, by (database, table, column), for the fields
+# declaring a key_catalog_timeout
+_key_catalogs = {}
+
+
+def clear_key_catalogs():
+    _key_catalogs.clear()
+
+
 class HStoreWhereNode(WhereNode):
 
     def make_atom(self, child, qn, connection):
         lvalue, lookup_type, value_annot, param = child
-        kwargs = {'connection': connection} if VERSION[:2] >= (1, 3) else {}
         
-        if lvalue and lvalue.field and hasattr(lvalue.field, 'db_type') and lvalue.field.db_type(**kwargs) == 'hstore':
+        if lvalue and lvalue.field and is_hstore_field(lvalue.field, connection):
+            hstore_field = lvalue.field
             try:
                 lvalue, params = lvalue.process(lookup_type, param, connection)
             except EmptyShortCircuit:
                 raise EmptyResultSet
             field = self.sql_for_columns(lvalue, qn, connection)
             
-            if lookup_type == 'exact':
-                if isinstance(param, dict):
-                    return ('%s = %%s' % field, [param])
-                else:
-                    raise ValueError('invalid value')
-            
-            elif lookup_type in ('gt', 'gte', 'lt', 'lte'):
-                if isinstance(param, dict) and len(param) == 1:
-                    sign = (lookup_type[0] == 'g' and '>%s' or '<%s') % (
-                        lookup_type[-1] == 'e' and '=' or '')
-                    return ('%s->\'%s\' %s %%s' % (field, param.keys()[0], sign), param.values())
-                else:
-                    raise ValueError('invalid value')
-            
-            elif lookup_type in ['contains', 'icontains']:
-                if isinstance(param, dict):
-                    values = param.values()
-                    if len(values) == 1 and isinstance(values[0], (list, tuple)):
-                        return ('%s->\'%s\' = ANY(%%s)' % (field, param.keys()[0]), [map(str, values[0])])
-                    else:
-                        return ('%s @> %%s' % field, [param])
-                elif isinstance(param, (list, tuple)):
-                    if len(param) < 2:
-                        return ('%s ? %%s' % field, [param[0]])
-                    if param:
-                        return ('%s ?& %%s' % field, [param])
-                    else:
-                        raise ValueError('invalid value')
-                elif isinstance(param, basestring):
-                    # if looking for a string perform the normal text lookup
-                    # that is: look for occurence of string in all the keys
-                    pass
-                else:
-                    raise ValueError('invalid value')
-            else:
-                raise TypeError('invalid lookup type')
+            key = (id(hstore_field), field, lookup_type, atom_shape(lookup_type, param))
+            try:
+                atom = _atom_cache[key]
+                _atom_stats['hits'] += 1
+            except KeyError:
+                atom = compile_atom(field, lookup_type, param, getattr(hstore_field, 'key_casts', {}))
+                _atom_stats['misses'] += 1
+                if len(_atom_cache) >= ATOM_CACHE_SIZE:
+                    _atom_cache.clear()
+                _atom_cache[key] = atom
+            if atom is not None:
+                sql, build_params = atom
+                return (sql, build_params(param))
         
         return super(HStoreWhereNode, self).make_atom(child, qn, connection)
     
@@ -112,6 +374,7 @@ class HStoreWhereNode(WhereNode):
 
 
 class HStoreQuery(Query):
+    query_terms = dict.fromkeys(list(QUERY_TERMS) + list(HSTORE_TERMS))
 
     def __init__(self, model):
         super(HStoreQuery, self).__init__(model, HStoreWhereNode)
@@ -122,6 +385,49 @@ class HStoreQuerySet(QuerySet):
     def __init__(self, model=None, query=None, using=None):
         query = query or HStoreQuery(model)
         super(HStoreQuerySet, self).__init__(model=model, query=query, using=using)
+        self._prefetch_references = ()
+
+    def _clone(self, *args, **kwargs):
+        clone = super(HStoreQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_references = self._prefetch_references
+        return clone
+
+    def iterator(self):
+        if not self._prefetch_references:
+            return super(HStoreQuerySet, self).iterator()
+        return self._prefetched_iterator()
+
+    def _prefetched_iterator(self):
+        instances = super(HStoreQuerySet, self).iterator()
+        return self._populated_chunks(instances, PREFETCH_CHUNK_SIZE)
+
+    def _populate_references(self, instances):
+        for attr in self._prefetch_references:
+            dictionaries = [getattr(instance, attr) for instance in instances]
+            references = set()
+            for dictionary in dictionaries:
+                references.update(value for value in dictionary.itervalues() if isinstance(value, basestring))
+            resolved = util.acquire_references(references)
+            for dictionary in dictionaries:
+                dictionary.populate(resolved)
+
+    def prefetch_references(self, *attrs):
+        """
+        Resolves the references stored in the specified references fields as
+        the results are fetched, issuing a single query per referenced model
+        for every PREFETCH_CHUNK_SIZE rows. Passing None clears any previously
+        requested prefetch.
+        """
+        clone = self._clone()
+        if attrs == (None,):
+            clone._prefetch_references = ()
+            return clone
+        for attr in attrs:
+            field = self.model._meta.get_field_by_name(attr)[0]
+            if not isinstance(field, ReferencesField):
+                raise ValueError('%s is not a references field' % attr)
+        clone._prefetch_references = self._prefetch_references + attrs
+        return clone
 
     @select_query
     def hkeys(self, query, attr):
@@ -155,25 +461,627 @@ class HStoreQuerySet(QuerySet):
             return dict((key, field._value_to_python(value)) for key, value in result[0].iteritems())
         return {}
 
+    @select_query
+    def hpeek_values(self, query, attr, key, chunk_size=None):
+        """
+        Iterates over (pk, value) pairs with the value of the specified key for
+        every row, streamed from a server side cursor.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        select = SortedDict([('_pk', self._pk_column()), ('_', '"%s" -> %%s' % attr)])
+        query.add_extra(select, [key], None, None, None, None)
+        sql, params = query.get_compiler(self.db).as_sql()
+        return ((pk, None if value is None else field._value_to_python(value))
+                for pk, value in server_side_rows(self.db, sql, params, chunk_size))
+
+    @select_query
+    def hslice_values(self, query, attr, keys, chunk_size=None):
+        """
+        Iterates over (pk, slice) pairs with the specified key/value pairs of
+        every row, streamed from a server side cursor.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        select = SortedDict([('_pk', self._pk_column()), ('_', 'slice("%s", %%s)' % attr)])
+        query.add_extra(select, [keys], None, None, None, None)
+        sql, params = query.get_compiler(self.db).as_sql()
+        return ((pk, dict((key, field._value_to_python(value)) for key, value in (hstore or {}).iteritems()))
+                for pk, hstore in server_side_rows(self.db, sql, params, chunk_size))
+
+    @select_query
+    def stream(self, query, chunk_size=None, raw=False):
+        """
+        Iterates over the matched instances, fetched chunk_size rows at a time
+        from a server side cursor so that memory use does not grow with the
+        result. When raw, yields dictionaries of the values as returned by the
+        driver instead, hstores being left undecoded.
+        """
+        chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        fields = self._select_all_fields(query)
+        sql, params = query.get_compiler(self.db).as_sql()
+        rows = server_side_rows(self.db, sql, params, chunk_size)
+        if raw:
+            names = [field.attname for field in fields]
+            return (dict(zip(names, row)) for row in rows)
+        return self._stream_instances(rows, chunk_size)
+
+    @select_query
+    def copy_to(self, query, fileobj, format='csv', keys=None, attr=None):
+        """
+        Writes the matched rows to a file-like object through COPY TO STDOUT,
+        as CSV with a header or as JSON lines (PostgreSQL 9.3+), without
+        building instances. Given keys, the values of those keys in the attr
+        hstore, the only hstore of the model by default, are written as
+        columns instead of the whole hstore. Values are written as stored.
+        """
+        if format not in ('csv', 'jsonl'):
+            raise ValueError('invalid format: %s' % format)
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        fields = self.model._meta.fields
+        expanded = None
+        if keys:
+            if attr is not None:
+                expanded = self.model._meta.get_field_by_name(attr)[0]
+            else:
+                hstores = [field for field in fields if isinstance(field, HStoreField)]
+                if len(hstores) != 1:
+                    raise ValueError('the hstore of the keys must be specified')
+                expanded = hstores[0]
+        self._select_all_fields(query)
+        subquery, params = query.get_compiler(self.db).as_sql()
+        columns = ['"_r".%s' % qn(field.column) for field in fields if field is not expanded]
+        for key in keys or ():
+            column = '%s AS %s' % (key_sql('"_r".%s' % qn(expanded.column), key), quote_key(key))
+            columns.append(params and column.replace('%', '%%') or column)
+        sql = 'SELECT %s FROM (%s) AS "_r"' % (', '.join(columns), subquery)
+        cursor = connection.cursor()
+        sql = cursor.mogrify(sql, params or None)
+        if format == 'csv':
+            sql = 'COPY (%s) TO STDOUT WITH CSV HEADER' % sql
+        else:
+            # CSV which never quotes, as JSON escapes control characters
+            sql = ('COPY (SELECT row_to_json("_j") FROM (%s) AS "_j") TO STDOUT '
+                   "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')" % sql)
+        cursor.copy_expert(sql, fileobj)
+
+    def _select_all_fields(self, query):
+        """
+        Sets query to select the columns of every field of the model, the
+        tables of parent models being joined, and returns the fields.
+        """
+        query.clear_deferred_loading()
+        query.select_related = False
+        query.set_extra_mask(())
+        query.set_aggregate_mask(())
+        compiler = query.get_compiler(self.db)
+        query.select = compiler.get_default_columns(start_alias=query.get_initial_alias(), as_pairs=True)[0]
+        query.select_fields = list(self.model._meta.fields)
+        return query.select_fields
+
+    def _stream_instances(self, rows, chunk_size):
+        def instances():
+            for row in rows:
+                instance = self.model(*row)
+                instance._state.db = self.db
+                instance._state.adding = False
+                yield instance
+        return self._populated_chunks(instances(), chunk_size)
+
+    def _populated_chunks(self, instances, chunk_size):
+        """
+        Yields the instances, resolving the prefetched references of
+        chunk_size of them at a time.
+        """
+        chunk = []
+        for instance in instances:
+            chunk.append(instance)
+            if len(chunk) == chunk_size:
+                self._populate_references(chunk)
+                for instance in chunk:
+                    yield instance
+                chunk = []
+        self._populate_references(chunk)
+        for instance in chunk:
+            yield instance
+
+    def annotate_keys(self, **aliases):
+        """
+        Selects the values of single hstore keys as extra columns, given
+        aliases mapped to (attr, key) pairs. Values are selected as stored.
+        """
+        qn = connections[self.db].ops.quote_name
+        table = qn(self.model._meta.db_table)
+        select, params = SortedDict(), []
+        for alias, (attr, key) in sorted(aliases.iteritems()):
+            field = self.model._meta.get_field_by_name(attr)[0]
+            select[alias] = '%s.%s -> %%s' % (table, qn(field.column))
+            params.append(key)
+        return self.extra(select=select, select_params=params)
+
+    def hvalues(self, attr, keys, *fields):
+        """
+        Iterates over dictionaries holding the specified fields (the primary
+        key by default) and the decoded values of the specified keys, without
+        fetching the whole hstore.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        queryset = self.annotate_keys(**dict((key, (attr, key)) for key in keys))
+        queryset = queryset.values(*(fields or ('pk',)) + tuple(keys))
+        return (self._decode_keys(field, row, keys) for row in queryset)
+
+    def hdicts(self, attr, decode=True):
+        """
+        Iterates over (pk, dictionary) pairs with the hstores of the matched
+        rows as returned by the driver, without instantiating models. Unless
+        decode is False the dictionaries are decoded by the field's codec.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        if decode and not hasattr(field, 'codec'):
+            raise ValueError('%s is not a dictionary field' % attr)
+        rows = self.values_list('pk', attr).iterator()
+        if not decode:
+            return ((pk, hstore or {}) for pk, hstore in rows)
+        decode_dict = field.codec.decode_dict
+        return ((pk, decode_dict(hstore) if hstore else {}) for pk, hstore in rows)
+
+    @staticmethod
+    def _decode_keys(field, row, keys):
+        for key in keys:
+            if row[key] is not None:
+                row[key] = field._value_to_python(row[key])
+        return row
+
+    def hkeys_distinct(self, attr, sample=None):
+        """
+        Returns the sorted union of the keys of the specified hstore over the
+        matched rows, computed by the database. Given a sample percentage only
+        that share of the table pages is scanned (TABLESAMPLE, PostgreSQL 9.5+).
+
+        The keys of the whole table are kept in a catalog for
+        key_catalog_timeout seconds when the field sets that option.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        filtered = bool(self.query.where)
+        catalog = getattr(field, 'key_catalog_timeout', None) is not None and sample is None and not filtered
+        if catalog:
+            catalog_key = (self.db, self.model._meta.db_table, field.column)
+            stamp, keys = _key_catalogs.get(catalog_key, (None, None))
+            if stamp is not None and time.time() - stamp < field.key_catalog_timeout:
+                return list(keys)
+        sql = 'SELECT DISTINCT skeys(%s) FROM %s' % (self._column(field), qn(self.model._meta.db_table))
+        params = []
+        if sample is not None:
+            sql += ' TABLESAMPLE SYSTEM (%s)'
+            params.append(sample)
+        if filtered:
+            subquery, restriction = self.values_list('pk', flat=True).query.get_compiler(self.db).as_sql()
+            sql = '%s WHERE %s IN (%s)' % (sql, self._pk_column(), subquery)
+            params.extend(restriction)
+        cursor = connection.cursor()
+        cursor.execute(sql + ' ORDER BY 1', params)
+        keys = [row[0] for row in cursor.fetchall()]
+        if catalog:
+            _key_catalogs[catalog_key] = (time.time(), keys)
+        return list(keys)
+
+    @select_query
+    def hkey_counts(self, query, attr):
+        """
+        Counts the matched rows holding each key of the specified hstore,
+        returning (key, count) pairs, the most common first.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.add_extra({'_': 'skeys(%s)' % self._column(field)}, None, None, None, None, None)
+        return self._aggregate(query, 'SELECT "_", COUNT(*) FROM (%s) AS "_t" GROUP BY "_" ORDER BY 2 DESC, 1')
+
+    @select_query
+    def hvalue_counts(self, query, attr, key):
+        """
+        Counts the matched rows holding each value of the specified key,
+        returning (value, count) pairs, the most common first.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.add_extra({'_': '%s -> %%s' % self._column(field)}, [key], None, None, None, None)
+        rows = self._aggregate(query, 'SELECT "_", COUNT(*) FROM (%s) AS "_t" WHERE "_" IS NOT NULL '
+                                      'GROUP BY "_" ORDER BY 2 DESC, 1')
+        return [(field._value_to_python(value), count) for value, count in rows]
+
+    def hsum(self, attr, key):
+        """
+        Sums the numeric values of the specified key, ignoring other values.
+        """
+        return self._aggregate_key('SUM', attr, key)
+
+    def havg(self, attr, key):
+        """
+        Averages the numeric values of the specified key.
+        """
+        return self._aggregate_key('AVG', attr, key)
+
+    def hmin(self, attr, key):
+        """
+        Returns the smallest numeric value of the specified key.
+        """
+        return self._aggregate_key('MIN', attr, key)
+
+    def hmax(self, attr, key):
+        """
+        Returns the largest numeric value of the specified key.
+        """
+        return self._aggregate_key('MAX', attr, key)
+
+    @select_query
+    def _aggregate_key(self, query, function, attr, key):
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.add_extra({'_': numeric_key_sql(self._column(field), key)}, None, None, None, None, None)
+        return self._aggregate(query, 'SELECT %s("_") FROM (%%s) AS "_t"' % function)[0][0]
+
+    def _aggregate(self, query, sql):
+        """
+        Runs an aggregate over the rows of the given query, used as subquery.
+        """
+        query.clear_ordering(True)
+        subquery, params = query.get_compiler(self.db).as_sql()
+        cursor = connections[self.db].cursor()
+        cursor.execute(sql % subquery, params)
+        return cursor.fetchall()
+
+    def _column(self, field):
+        qn = connections[self.db].ops.quote_name
+        return '%s.%s' % (qn(self.model._meta.db_table), qn(field.column))
+
+    def _pk_column(self):
+        qn = connections[self.db].ops.quote_name
+        return '%s.%s' % (qn(self.model._meta.db_table), qn(self.model._meta.pk.column))
+
+    @staticmethod
+    def batch(using=None):
+        """
+        Returns a context in which hupdate, hremove and hdelta calls are
+        deferred and then run together, see HStoreBatch.
+        """
+        return HStoreBatch(using)
+
     @update_query
-    def hremove(self, query, attr, keys):
+    def hremove(self, attr, keys):
         """
         Removes the specified keys in the specified hstore.
         """
-        value = QueryWrapper('delete("%s", %%s)' % attr, [keys])
-        field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
-        query.add_update_fields([(field, None, value)])
-        return query
+        return attr, None, keys
 
     @update_query
-    def hupdate(self, query, attr, updates):
+    def hupdate(self, attr, updates):
         """
         Updates the specified hstore.
         """
-        value = QueryWrapper('"%s" || %%s' % attr, [updates])
-        field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
-        query.add_update_fields([(field, None, value)])
-        return query
+        return attr, updates, None
+
+    @update_query
+    def hdelta(self, attr, updates, keys):
+        """
+        Removes the specified keys and merges the serialized updates into the
+        specified hstore with a single statement.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        return attr, updates and field.get_prep_value(updates), keys
+
+    def bulk_hupdate(self, attr, updates, batch_size=None):
+        """
+        Updates the specified hstore of many rows, each with its own values,
+        given a dictionary mapping primary keys to updates.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        rows = [(pk, field.get_prep_value(values)) for pk, values in updates.iteritems() if values]
+        return self._bulk_update(field, '%(column)s || "_v"."value"', '%s', rows, batch_size)
+    bulk_hupdate.alters_data = True
+
+    def bulk_hremove(self, attr, removals, batch_size=None):
+        """
+        Removes keys from the specified hstore of many rows, given a dictionary
+        mapping primary keys to the keys to remove from each row.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        rows = [(pk, [keys] if isinstance(keys, basestring) else list(keys))
+                for pk, keys in removals.iteritems() if keys]
+        return self._bulk_update(field, 'delete(%(column)s, "_v"."value")', '%s::text[]', rows, batch_size)
+    bulk_hremove.alters_data = True
+
+    def copy_from(self, rows, fields=None, chunk_size=None):
+        """
+        Loads rows, given as model instances, dictionaries of field values or
+        sequences of the values of the specified fields, into the table with
+        COPY, chunk_size rows per statement. Hstores are
+        encoded by their field and sent in the hstore text format. Returns the
+        number of loaded rows.
+        """
+        self._for_write = True
+        chunk_size = chunk_size or COPY_CHUNK_SIZE
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        if fields is None:
+            fields = [field for field in opts.local_fields if not isinstance(field, AutoField)]
+        else:
+            fields = [opts.get_field(name) for name in fields]
+        sql = 'COPY %s (%s) FROM STDIN' % (qn(opts.db_table), ', '.join(qn(field.column) for field in fields))
+
+        def encode(field, value):
+            if isinstance(field, HStoreField):
+                value = field.get_prep_value(value)
+                return None if value is None else util.hstore_literal(value)
+            return field.get_db_prep_save(value, connection=connection)
+
+        def line(row):
+            # values are taken as bulk_create() does, through pre_save() of
+            # an instance which has the defaults of the missing fields
+            if isinstance(row, dict):
+                row = self.model(**row)
+            elif isinstance(row, (list, tuple)):
+                row = self.model(**dict((field.attname, value) for field, value in zip(fields, row)))
+            values = [field.pre_save(row, True) for field in fields]
+            return u'\t'.join(util.copy_text(encode(field, value)) for field, value in zip(fields, values))
+
+        def execute():
+            cursor = connection.cursor()
+            count, lines = 0, []
+            for row in rows:
+                lines.append(line(row))
+                if len(lines) == chunk_size:
+                    cursor.copy_expert(sql, StringIO(u'\n'.join(lines).encode('utf-8') + '\n'))
+                    count, lines = count + len(lines), []
+            if lines:
+                cursor.copy_expert(sql, StringIO(u'\n'.join(lines).encode('utf-8') + '\n'))
+                count += len(lines)
+            return count
+
+        return managed_write(self.db, execute)
+    copy_from.alters_data = True
+
+    def hupsert(self, lookup, attr, updates, defaults=None, batch_size=None):
+        """
+        Merges dictionaries into the specified hstore of the rows matching the
+        lookup field, creating the rows which do not exist yet, given a
+        dictionary mapping lookup values (tuples for several lookup fields) to
+        the updates of each row. The lookup fields must be unique together.
+        Created rows take their other columns from defaults, or the field
+        defaults. Returns the number of created or updated rows.
+
+        On PostgreSQL 9.5+ each batch is a single INSERT ... ON CONFLICT,
+        older servers update the existing rows and then insert the others.
+        """
+        self._for_write = True
+        batch_size = batch_size or BULK_BATCH_SIZE
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        field = opts.get_field_by_name(attr)[0]
+        lookups = [lookup] if isinstance(lookup, basestring) else list(lookup)
+        lookup_fields = [opts.get_field_by_name(name)[0] for name in lookups]
+        defaults = defaults or {}
+        other_fields = [f for f in opts.local_fields
+                        if f is not field and f not in lookup_fields and not isinstance(f, AutoField)]
+        rows = []
+        for values, row_updates in updates.iteritems():
+            values = [values] if len(lookup_fields) == 1 else list(values)
+            values = [f.get_db_prep_save(value, connection=connection) for f, value in zip(lookup_fields, values)]
+            # the other columns of each row to create, through pre_save() of
+            # an instance built from defaults so callable defaults and
+            # auto_now fields are evaluated per row
+            instance = self.model(**defaults)
+            others = [f.get_db_prep_save(f.pre_save(instance, True), connection=connection) for f in other_fields]
+            rows.append((values, others, field.get_prep_value(row_updates) or {}))
+
+        table = qn(opts.db_table)
+        column = qn(field.column)
+        fields = lookup_fields + other_fields + [field]
+        insert = 'INSERT INTO %s (%s) VALUES %%s' % (table, ', '.join(qn(f.column) for f in fields))
+        placeholder = '(%s)' % ', '.join(['%s'] * len(fields))
+
+        def upsert(cursor, batch):
+            sql = '%s ON CONFLICT (%s) DO UPDATE SET %s = COALESCE(%s.%s, \'\'::hstore) || EXCLUDED.%s' % (
+                insert, ', '.join(qn(f.column) for f in lookup_fields), column, table, column, column)
+            params = [param for values, others, hstore in batch for param in values + others + [hstore]]
+            cursor.execute(sql % ', '.join([placeholder] * len(batch)), params)
+            return cursor.rowcount
+
+        def update_then_insert(cursor, batch):
+            # the rows are numbered in "_v"."_i" and the updated ones are
+            # told by their number, the lookup values coming back from the
+            # database need not compare equal to the values sent
+            names = ['"_l%d"' % index for index in range(len(lookup_fields))]
+            sql = ('UPDATE %s SET %s = COALESCE(%s.%s, \'\'::hstore) || "_v"."value" '
+                   'FROM (VALUES %%s) AS "_v" ("_i", %s, "value") WHERE %s RETURNING "_v"."_i"') % (
+                table, column, table, column, ', '.join(names),
+                ' AND '.join('%s.%s = "_v".%s' % (table, qn(f.column), name) for f, name in zip(lookup_fields, names)))
+            joined = ', '.join(['(%s)' % ', '.join(['%s'] * (len(lookup_fields) + 2))] * len(batch))
+            params = [param for index, (values, others, hstore) in enumerate(batch)
+                      for param in [index] + values + [hstore]]
+            cursor.execute(sql % joined, params)
+            updated = set(index for index, in cursor.fetchall())
+            missing = [row for index, row in enumerate(batch) if index not in updated]
+            if missing:
+                params = [param for values, others, hstore in missing for param in values + others + [hstore]]
+                cursor.execute(insert % ', '.join([placeholder] * len(missing)), params)
+            return len(updated) + len(missing)
+
+        def execute():
+            cursor = connection.cursor()
+            merge = upsert if connection.connection.server_version >= 90500 else update_then_insert
+            count = 0
+            for offset in xrange(0, len(rows), batch_size):
+                count += merge(cursor, rows[offset:offset + batch_size])
+            return count
+
+        return managed_write(self.db, execute)
+    hupsert.alters_data = True
+
+    def _bulk_update(self, field, expression, placeholder, rows, batch_size=None):
+        """
+        Sets field to expression for every (pk, value) row, joining the rows as
+        VALUES; the value of each row is available as "_v"."value".
+        """
+        self._for_write = True
+        batch_size = batch_size or BULK_BATCH_SIZE
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        pk = '%s.%s' % (table, qn(self.model._meta.pk.column))
+        column = '%s.%s' % (table, qn(field.column))
+        sql = 'UPDATE %s SET %s = %s FROM (VALUES %%s) AS "_v" ("pk", "value") WHERE %s = "_v"."pk"' % (
+            table, qn(field.column), expression % {'column': column}, pk)
+        restriction = []
+        if self.query.where:
+            subquery, restriction = self.values_list('pk', flat=True).query.get_compiler(self.db).as_sql()
+            sql = '%s AND %s IN (%s)' % (sql, pk, subquery.replace('%', '%%'))
+            restriction = list(restriction)
+
+        def execute():
+            cursor = connection.cursor()
+            count = 0
+            for offset in xrange(0, len(rows), batch_size):
+                batch = rows[offset:offset + batch_size]
+                values = ', '.join(['(%%s, %s)' % placeholder] * len(batch))
+                params = [param for row in batch for param in row] + restriction
+                cursor.execute(sql % values, params)
+                count += cursor.rowcount
+            return count
+
+        count = managed_write(self.db, execute)
+        self._result_cache = None
+        return count
+
+
+class DeferredUpdate(object):
+    """
+    An hstore update deferred by an HStoreBatch. The number of updated rows
+    is known once the batch has run.
+    """
+    def __init__(self, queryset, attr, updates, keys):
+        self.query = queryset.query.clone(UpdateQuery)
+        self.model = queryset.model
+        self.using = queryset.db
+        self.attr = attr
+        self.updates = updates
+        self.keys = keys
+        self.rows = None
+        try:
+            sql, params = queryset.query.get_compiler(self.using).as_sql()
+        except EmptyResultSet:
+            self.rows = 0
+            self.target = None
+        else:
+            self.target = (self.model, self.using, attr, sql, repr(params))
+
+
+class HStoreBatch(object):
+    """
+    Defers the hstore updates issued in its context. On a clean exit the
+    updates run in call order, in a single transaction per database, with
+    consecutive updates of the same row set and attribute coalesced into one
+    statement. Deferred calls return a DeferredUpdate, results lists their
+    row counts in call order.
+    """
+    _local = threading.local()
+
+    def __init__(self, using=None):
+        self.using = using
+        self.calls = []
+        self.results = None
+
+    @classmethod
+    def current(cls, using):
+        """
+        Returns the innermost active batch for the specified database.
+        """
+        for batch in reversed(getattr(cls._local, 'stack', ())):
+            if batch.using is None or batch.using == using:
+                return batch
+
+    def defer(self, queryset, attr, updates, keys):
+        call = DeferredUpdate(queryset, attr, updates, keys)
+        self.calls.append(call)
+        return call
+
+    def execute(self):
+        """
+        Runs the deferred updates, returning their row counts.
+        """
+        runs = []
+        for call in self.calls:
+            if call.target is None:
+                continue
+            # only adjacent calls are merged, others may touch the same rows
+            if runs and runs[-1][0].target == call.target:
+                runs[-1].append(call)
+            else:
+                runs.append([call])
+        databases = SortedDict()
+        for calls in runs:
+            databases.setdefault(calls[0].using, []).append(calls)
+        for using, groups in databases.iteritems():
+            managed_write(using, lambda: [self._execute(using, calls) for calls in groups])
+        self.calls, calls = [], self.calls
+        self.results = [call.rows for call in calls]
+        return self.results
+
+    def _execute(self, using, calls):
+        first = calls[0]
+        sql, params = '"%s"' % first.attr, []
+        for call in calls:
+            sql, params = hstore_delta(sql, params, call.updates, call.keys)
+        field = first.model._meta.get_field_by_name(first.attr)[0]
+        first.query.add_update_fields([(field, None, QueryWrapper(sql, params))])
+        rows = first.query.get_compiler(using).execute_sql(None)
+        for call in calls:
+            call.rows = rows
+
+    def __enter__(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.stack.remove(self)
+        if exc_type is None:
+            self.execute()
+
+
+class RemovalQueue(object):
+    """
+    Collects key removals from many instances and flushes them together, with
+    one bulk_hremove per model, field and database. Used as a context manager
+    the queue is flushed on a clean exit.
+    """
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.pending = {}
+
+    def add(self, instance, attr, keys):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        removals = self.pending.setdefault((type(instance), attr, instance._state.db), {})
+        removals.setdefault(instance.pk, set()).update(keys)
+
+    def flush(self):
+        """
+        Removes all the queued keys, returning the number of updated rows.
+        """
+        rows = 0
+        pending, self.pending = self.pending, {}
+        for (model, attr, using), removals in pending.iteritems():
+            queryset = model._base_manager.get_query_set().using(using)
+            rows += queryset.bulk_hremove(attr, removals, self.batch_size)
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
 
 
 try:
@@ -182,7 +1090,8 @@ try:
     from django.contrib.gis.db.models.sql.where import GeoWhereNode, GeoConstraint
 
     class HStoreGeoQuery(GeoQuery, Query):
-        
+        query_terms = dict.fromkeys(list(GeoQuery.query_terms) + list(HSTORE_TERMS))
+
         def __init__(self, *args, **kwargs):
             model = kwargs.pop('model', None) or args[0]
             super(HStoreGeoQuery, self).__init__(model, HStoreGeoWhereNode)
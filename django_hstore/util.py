@@ -3,23 +3,103 @@ import datetime
 try: import simplejson as json
 except ImportError: import json
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.loading import get_models
+from django.db.models.signals import class_prepared
+from django.utils.encoding import force_unicode
+
+
+# upper bound of the reference registries, they are emptied once it is reached
+REFERENCE_CACHE_SIZE = 1024
+
+# "module.Class" prefix -> model class
+_reference_models = {}
+# model class -> "module.Class" prefix
+_reference_prefixes = {}
+
+
+def reference_prefix(model):
+    """
+    Returns the "module.Class" prefix used to reference instances of a model.
+    """
+    try:
+        return _reference_prefixes[model]
+    except KeyError:
+        prefix = '%s.%s' % (model.__module__, model.__name__)
+        if len(_reference_prefixes) >= REFERENCE_CACHE_SIZE:
+            _reference_prefixes.clear()
+        _reference_prefixes[model] = prefix
+        return prefix
+
+
+def reference_model(implementation):
+    """
+    Returns the model class for a "module.Class" reference prefix. Classes are
+    looked up in the app registry first and imported only as a last resort.
+    """
+    try:
+        return _reference_models[implementation]
+    except KeyError:
+        pass
+    for model in get_models(include_auto_created=True):
+        if reference_prefix(model) == implementation:
+            break
+    else:
+        module, sep, attr = implementation.rpartition('.')
+        model = getattr(__import__(module, fromlist=(attr,)), attr)
+    if len(_reference_models) >= REFERENCE_CACHE_SIZE:
+        _reference_models.clear()
+    _reference_models[implementation] = model
+    return model
+
+
+def clear_reference_cache(**kwargs):
+    """
+    Empties the reference registries. Runs whenever a model class is prepared.
+    """
+    _reference_models.clear()
+    _reference_prefixes.clear()
+
+class_prepared.connect(clear_reference_cache, dispatch_uid='django_hstore.util.clear_reference_cache')
 
 
 def acquire_reference(reference):
     try:
         implementation, identifier = reference.split(':')
-        module, sep, attr = implementation.rpartition('.')
-        implementation = getattr(__import__(module, fromlist=(attr,)), attr)
-        return implementation.objects.get(pk=identifier)
+        return reference_model(implementation).objects.get(pk=identifier)
     except ObjectDoesNotExist:
         return None
     except Exception:
         raise ValueError
 
 
+def acquire_references(references):
+    """
+    Resolves many references at once, issuing a single query per model.
+    Returns a dictionary mapping each reference to its instance, or to None
+    when the referenced instance does not exist.
+    """
+    identifiers = {}
+    for reference in set(references):
+        try:
+            implementation, identifier = reference.split(':')
+        except Exception:
+            raise ValueError
+        identifiers.setdefault(implementation, set()).add(identifier)
+    refs = dict.fromkeys(references)
+    for implementation, pks in identifiers.iteritems():
+        try:
+            instances = list(reference_model(implementation).objects.filter(pk__in=pks))
+        except Exception:
+            raise ValueError
+        for instance in instances:
+            reference = '%s:%s' % (implementation, instance.pk)
+            if reference in refs:
+                refs[reference] = instance
+    return refs
+
+
 def identify_instance(instance):
-    implementation = type(instance)
-    return '%s.%s:%s' % (implementation.__module__, implementation.__name__, instance.pk)
+    return '%s:%s' % (reference_prefix(type(instance)), instance.pk)
 
 
 def serialize_references(references):
@@ -54,6 +134,14 @@ def unserialize_references(references):
         return refs
 
 
+# first characters of JSON documents which are not literals
+JSON_STARTS = frozenset('"{[-0123456789 \t\n\r')
+# literal documents which json.loads accepts
+JSON_LITERALS = frozenset(('true', 'false', 'null', 'NaN', 'Infinity'))
+JSON_LITERAL_STARTS = frozenset(literal[0] for literal in JSON_LITERALS)
+JSON_WHITESPACE = ' \t\n\r'
+
+
 def json_serialize_dict(d):
     return dict([(k, json_serialize_value(v)) for k,v in d.items()])
 
@@ -72,14 +160,27 @@ def json_serialize_value(value):
 
 
 def json_unserialize_value(value):
-    try:
-        value = json.loads(value)
-    except ValueError:
-        pass
+    if not isinstance(value, basestring) or maybe_json(value):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
     value = destringify_datetime(value)
     return value
 
 
+def maybe_json(value):
+    """
+    Cheaply tells apart strings which cannot possibly be JSON documents, so
+    that plain strings do not pay for a failed json.loads.
+    """
+    if not value:
+        return False
+    if value[0] in JSON_LITERAL_STARTS:
+        return value.rstrip(JSON_WHITESPACE) in JSON_LITERALS
+    return value[0] in JSON_STARTS
+
+
 def serialize_queryset_arguments(hstore_fieldnames, *args, **kwargs):
     for k,v in kwargs.items():
         # Only serialize for filters where both:
@@ -98,6 +199,31 @@ def serialize_queryset_arguments(hstore_fieldnames, *args, **kwargs):
     return kwargs
 
 
+def hstore_quote(value):
+    """
+    Quotes a key or value of the hstore text format.
+    """
+    return u'"%s"' % force_unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+
+
+def hstore_literal(d):
+    """
+    Returns the hstore text format of a dictionary of strings.
+    """
+    return u', '.join(u'%s=>%s' % (hstore_quote(key), u'NULL' if value is None else hstore_quote(value))
+                      for key, value in d.iteritems())
+
+
+def copy_text(value):
+    """
+    Escapes a value for the text format of COPY, None being NULL.
+    """
+    if value is None:
+        return u'\\N'
+    return (force_unicode(value).replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+            .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
 def stringify_datetime(value):
     if isinstance(value, datetime.datetime):
         value = datetime.datetime.strftime(value, '%Y-%m-%d %H:%M:%S.%f')
@@ -111,19 +237,19 @@ def stringify_datetime(value):
 def destringify_datetime(value):
     if type(value) is str:
         # Try Datetime
-        if len(value) is 26:
+        if len(value) == 26 and value[4] == '-' and value[10] == ' ':
             try:
                 value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
             except ValueError:
                 pass
         # Try Date
-        elif len(value) is 10:
+        elif len(value) == 10 and value[4] == '-' and value[7] == '-':
             try:
                 value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
             except ValueError:
                 pass
         # Try Time
-        elif len(value) is 15:
+        elif len(value) == 15 and value[2] == ':' and value[5] == ':':
             try:
                 value = datetime.datetime.strptime(value, '%H:%M:%S.%f').time()
             except ValueError:
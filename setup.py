@@ -21,6 +21,7 @@ setup(
     url='https://github.com/alukach/django-hstore',
     packages=find_packages(exclude=['tests', 'tests.*']),
     zip_safe=False,
+    tests_require=['Django>=1.4,<1.5', 'psycopg2'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',
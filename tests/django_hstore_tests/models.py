@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.gis.db import models as geo_models
 from django_hstore import hstore
@@ -19,6 +21,44 @@ class DataBag(HStoreModel):
     data = hstore.DictionaryField()
 
 
+class ChildBag(DataBag):
+    kind = models.CharField(max_length=32)
+
+    objects = hstore.HStoreManager()
+
+
+class RawBag(HStoreModel):
+    name = models.CharField(max_length=32)
+    data = hstore.DictionaryField(codec='raw')
+
+
+class LazyBag(HStoreModel):
+    name = models.CharField(max_length=32)
+    data = hstore.DictionaryField(lazy=True)
+
+
+class IndexedBag(HStoreModel):
+    name = models.CharField(max_length=32)
+    data = hstore.DictionaryField(index_type='gin', indexed_keys=['status', ('price', 'numeric')])
+
+
+class CatalogBag(HStoreModel):
+    name = models.CharField(max_length=32)
+    data = hstore.DictionaryField(key_catalog_timeout=60)
+
+
+def new_token():
+    return uuid.uuid4().hex
+
+
+class UniqueBag(HStoreModel):
+    name = models.CharField(max_length=32, unique=True)
+    kind = models.CharField(max_length=32, default='plain')
+    token = models.CharField(max_length=32, unique=True, default=new_token)
+    created = models.DateTimeField(auto_now_add=True)
+    data = hstore.DictionaryField()
+
+
 class RefsBag(HStoreModel):
     name = models.CharField(max_length=32)
     refs = hstore.ReferencesField()
@@ -1,11 +1,22 @@
-from .models import DataBag, Ref, RefsBag, DefaultsModel, BadDefaultsModel, Location, NullableRefsBag
+from .models import CatalogBag, ChildBag, DataBag, IndexedBag, LazyBag, RawBag, Ref, RefsBag, UniqueBag, DefaultsModel, BadDefaultsModel, Location, NullableRefsBag
 
-from django.db import transaction
+from django.db import connection, connections, transaction
 from django.db.models.aggregates import Count
 from django.db.utils import IntegrityError
-from django.utils.unittest import TestCase
+from django.utils.unittest import TestCase, skipUnless
 from django.contrib.gis.geos import GEOSGeometry
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django_hstore import hstore, query, util
+from django_hstore.backends import oids
+import datetime
+from decimal import Decimal
 import json
+import os
+import pickle
+import sys
+from StringIO import StringIO
+import timeit
 
 
 class TestDictionaryField(TestCase):
@@ -65,6 +76,49 @@ class TestDictionaryField(TestCase):
         databag = DataBag.objects.get(name='boolean')
         self.assertEqual(json.loads(databag.data['boolean']), True)
 
+    def test_value_decoding(self):
+        self.assertEqual(util.json_unserialize_value('plain'), 'plain')
+        self.assertEqual(util.json_unserialize_value('truthy'), 'truthy')
+        self.assertEqual(util.json_unserialize_value('"quoted"'), 'quoted')
+        self.assertEqual(util.json_unserialize_value('true'), True)
+        self.assertEqual(util.json_unserialize_value('null'), None)
+        self.assertEqual(util.json_unserialize_value('-1.5'), -1.5)
+        self.assertEqual(util.json_unserialize_value('[1, "a"]'), [1, 'a'])
+        self.assertEqual(util.json_unserialize_value('{"a": 1}'), {'a': 1})
+        self.assertEqual(util.json_unserialize_value('2013-01-02'), datetime.date(2013, 1, 2))
+        self.assertEqual(util.json_unserialize_value('2013/01/02'), '2013/01/02')
+
+    def test_raw_codec(self):
+        RawBag.objects.create(name='raw', data={'s': 'plain', 'n': 1, 'l': [1, 2]})
+        bag = RawBag.objects.get(name='raw')
+        self.assertEqual(bag.data, {'s': 'plain', 'n': '1', 'l': '[1, 2]'})
+        self.assertEqual(RawBag.objects.hpeek(name='raw', attr='data', key='n'), '1')
+
+    def test_lazy_decoding(self):
+        LazyBag.objects.create(name='lazy', data={'n': 1, 'l': [1, 2], 's': 'text'})
+        bag = LazyBag.objects.get(name='lazy')
+        self.assertEqual(dict.__getitem__(bag.data, 'n'), '1')
+        self.assertEqual(bag.data['n'], 1)
+        self.assertEqual(dict.__getitem__(bag.data, 'n'), 1)
+        self.assertEqual(dict.__getitem__(bag.data, 'l'), '[1, 2]')
+        self.assertEqual(bag.data.get('l'), [1, 2])
+        self.assertEqual(sorted(bag.data.items()), [('l', [1, 2]), ('n', 1), ('s', 'text')])
+
+        bag.data['n'] = 2
+        bag.save()
+        self.assertEqual(LazyBag.objects.get(name='lazy').data, {'n': 2, 'l': [1, 2], 's': 'text'})
+
+    def test_pickling(self):
+        bag = DataBag(name='pickled', data={'a': 1})
+        bag.data['b'] = [2]
+        restored = pickle.loads(pickle.dumps(bag, 2))
+        self.assertEqual(restored.data, {'a': 1, 'b': [2]})
+        self.assertTrue(restored.data.instance is restored)
+        self.assertTrue(restored.data.has_changes())
+        LazyBag.objects.create(name='pickled', data={'n': 1})
+        restored = pickle.loads(pickle.dumps(LazyBag.objects.get(name='pickled'), 2))
+        self.assertEqual(dict(restored.data), {'n': 1})
+
     def test_empty_instantiation(self):
         bag = DataBag.objects.create(name='bag')
         self.assertTrue(isinstance(bag.data, dict))
@@ -172,6 +226,660 @@ class TestDictionaryField(TestCase):
         self.assertEqual(len(r), 1)
         self.assertEqual(r[0], alpha)
 
+    def test_multiple_key_value_in_subset_querying(self):
+        alpha, beta = self._create_bags()
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v'], beta.data['v']], 'v2': [beta.data['v2']]})
+        self.assertEqual(list(r), [beta])
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v'], beta.data['v']], 'v2': str(alpha.data['v2'])})
+        self.assertEqual(list(r), [alpha])
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v']], 'v2': [beta.data['v2']]})
+        self.assertEqual(r.count(), 0)
+
+    def test_compiled_atom_cache(self):
+        alpha, beta = self._create_bags()
+        query.clear_atom_cache()
+        self.assertEqual(DataBag.objects.filter(data__contains={'v': '1'}).count(), 1)
+        self.assertEqual(query.atom_cache_info()['misses'], 1)
+        self.assertEqual(DataBag.objects.filter(data__contains={'v': '2'}).count(), 1)
+        info = query.atom_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+        DataBag.objects.filter(data__contains={'v': ['1']}).count()
+        self.assertEqual(query.atom_cache_info()['misses'], 2)
+
+    def test_key_value_gt_querying(self):
+        alpha, beta = self._create_bags()
+        self.assertGreater(beta.data['v'], alpha.data['v'])
+        r = DataBag.objects.filter(data__gt={'v': alpha.data['v']})
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0], beta)
+        r = DataBag.objects.filter(data__gte={'v': alpha.data['v']})
+        self.assertEqual(len(r), 2)
+
+    def test_numeric_range_querying(self):
+        DataBag.objects.create(name='cheap', data={'price': 9})
+        DataBag.objects.create(name='dear', data={'price': 10.5})
+        DataBag.objects.create(name='free', data={'price': 'none'})
+        self.assertEqual([b.name for b in DataBag.objects.filter(data__gt={'price': 9})], ['dear'])
+        self.assertEqual(DataBag.objects.filter(data__gte={'price': 9}).count(), 2)
+        self.assertEqual([b.name for b in DataBag.objects.filter(data__lt={'price': 10})], ['cheap'])
+
+    def test_key_index_sql(self):
+        sql = query.key_index_sql(DataBag, 'data', 'price', numeric=True)
+        self.assertTrue(sql.startswith('CREATE INDEX'))
+        self.assertTrue(query.numeric_key_sql('"data"', 'price') in sql)
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        cursor.execute('DROP INDEX %s' % sql.split()[2])
+
+    def test_indexed_keys(self):
+        field = IndexedBag._meta.get_field_by_name('data')[0]
+        sql = connection.creation.sql_indexes_for_field(IndexedBag, field, no_style())
+        self.assertEqual(len(sql), 3)
+        self.assertTrue('USING GIN' in sql[0])
+        self.assertEqual(sql[1], query.key_index_sql(IndexedBag, 'data', 'status'))
+        self.assertEqual(sql[2], query.key_index_sql(IndexedBag, 'data', 'price', numeric=True))
+
+        IndexedBag.objects.create(name='a', data={'status': 'new', 'price': 5})
+        IndexedBag.objects.create(name='b', data={'status': 'old', 'price': 50})
+        self.assertEqual(IndexedBag.objects.get(data__contains={'status': '"new"'}).name, 'a')
+        self.assertEqual(IndexedBag.objects.get(data__contains={'status': '"old"', 'price': '50'}).name, 'b')
+        self.assertEqual(IndexedBag.objects.get(data__gt={'price': 10}).name, 'b')
+        self.assertRaises(ValueError, list, IndexedBag.objects.filter(data__gt={'price': 'ten'}))
+
+    def test_hstore_indexes_command(self):
+        out = StringIO()
+        call_command('hstore_indexes', stdout=out)
+        report = out.getvalue()
+        self.assertTrue('django_hstore_tests_indexedbag.data: declared gin, found django_hstore_tests_indexedbag_data_gin (gin), ok' in report)
+        self.assertFalse('mismatch' in report)
+
+    def test_key_value_lt_querying(self):
+        alpha, beta = self._create_bags()
+        self.assertLess(alpha.data['v'], beta.data['v'])
+        r = DataBag.objects.filter(data__lt={'v': beta.data['v']})
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0], alpha)
+        r = DataBag.objects.filter(data__lte={'v': beta.data['v']})
+        self.assertEqual(len(r), 2)
+
+    def test_multiple_key_subset_querying(self):
+        alpha, beta = self._create_bags()
+        for keys in (['v'], ['v', 'v2']):
+            self.assertEqual(DataBag.objects.filter(data__contains=keys).count(), 2)
+        for keys in (['v', 'nv'], ['n1', 'n2']):
+            self.assertEqual(DataBag.objects.filter(data__contains=keys).count(), 0)
+
+    def test_single_key_querying(self):
+        alpha, beta = self._create_bags()
+        for key in ('v', 'v2'):
+            self.assertEqual(DataBag.objects.filter(data__contains=[key]).count(), 2)
+        for key in ('n1', 'n2'):
+            self.assertEqual(DataBag.objects.filter(data__contains=[key]).count(), 0)
+    
+    def test_key_existence_querying(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v3': '1'})
+        self.assertEqual(DataBag.objects.filter(data__has_key='v').count(), 2)
+        self.assertEqual(DataBag.objects.filter(data__has_any_keys=['v2', 'v3']).count(), 3)
+        self.assertEqual(DataBag.objects.filter(data__has_any_keys=['n1', 'v3']).get(), gamma)
+        self.assertEqual(DataBag.objects.filter(data__has_all_keys=['v', 'v2']).count(), 2)
+        self.assertEqual(DataBag.objects.filter(data__has_all_keys=['v', 'v3']).count(), 0)
+
+    def test_not_contains_querying(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.filter(data__not_contains={'v': '1'}).get(), beta)
+        self.assertEqual(DataBag.objects.filter(data__not_contains='v').count(), 0)
+        self.assertEqual(DataBag.objects.filter(data__not_contains=['v', 'n1']).count(), 2)
+        hello = DataBag.objects.create(name='hello', data={'w': 'hello'})
+        self.assertEqual(DataBag.objects.get(data__contains={'w': '"hello"'}), hello)
+        self.assertEqual(DataBag.objects.filter(data__not_contains={'w': '"hello"'}).count(), 2)
+
+    def test_simple_text_icontains_querying(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'theKey': 'someverySpecialValue', 'v2': '3'})
+        
+        self.assertEqual(DataBag.objects.filter(data__contains='very').count(), 1)
+        self.assertEqual(DataBag.objects.filter(data__contains='very')[0].name, 'gamma')
+        self.assertEqual(DataBag.objects.filter(data__icontains='specialvalue').count(), 1)
+        self.assertEqual(DataBag.objects.filter(data__icontains='specialvalue')[0].name, 'gamma')
+        
+        self.assertEqual(DataBag.objects.filter(data__contains='the').count(), 1)
+        self.assertEqual(DataBag.objects.filter(data__contains='the')[0].name, 'gamma')
+        self.assertEqual(DataBag.objects.filter(data__icontains='eke').count(), 1)
+        self.assertEqual(DataBag.objects.filter(data__icontains='eke')[0].name, 'gamma')
+
+    def test_hkeys(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.hkeys(id=alpha.id, attr='data'), ['v', 'v2'])
+        self.assertEqual(DataBag.objects.hkeys(id=beta.id, attr='data'), ['v', 'v2'])
+
+    def test_hpeek(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='v'), 1)
+        self.assertEqual(DataBag.objects.filter(id=alpha.id).hpeek(attr='data', key='v'), 1)
+        self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='invalid'), None)
+
+    def test_hpeek_values(self):
+        alpha, beta = self._create_bags()
+        values = DataBag.objects.filter(name__in=['alpha', 'beta']).hpeek_values('data', 'v', chunk_size=1)
+        self.assertEqual(sorted(values), sorted([(alpha.pk, 1), (beta.pk, 2)]))
+        self.assertEqual(list(DataBag.objects.hpeek_values('data', 'invalid', name='alpha')), [(alpha.pk, None)])
+
+    def test_hslice_values(self):
+        alpha, beta = self._create_bags()
+        values = DataBag.objects.hslice_values('data', ['v', 'ggg'])
+        self.assertEqual(sorted(values), sorted([(alpha.pk, {'v': 1}), (beta.pk, {'v': 2})]))
+
+    def test_stream(self):
+        alpha, beta = self._create_bags()
+        bags = list(DataBag.objects.order_by('name').stream(chunk_size=1))
+        self.assertEqual(bags, [alpha, beta])
+        self.assertEqual(bags[1].data, beta.data)
+        rows = list(DataBag.objects.stream(raw=True, name='alpha'))
+        self.assertEqual(rows, [{'id': alpha.pk, 'name': 'alpha', 'data': {'v': '1', 'v2': '3'}}])
+        # the fields of parent models come from their table
+        child = ChildBag.objects.create(name='child', kind='k', data={'v': 1})
+        self.assertEqual([(bag.pk, bag.name, bag.kind, bag.data) for bag in ChildBag.objects.stream()],
+                         [(child.pk, 'child', 'k', {'v': 1})])
+
+    def test_copy_to(self):
+        alpha, beta = self._create_bags()
+        out = StringIO()
+        DataBag.objects.filter(name='alpha').copy_to(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,name,data')
+        self.assertEqual(lines[1].split(',')[:2], [str(alpha.pk), 'alpha'])
+        self.assertEqual(len(lines), 2)
+        out = StringIO()
+        DataBag.objects.copy_to(out, format='jsonl', keys=['v', 'x'])
+        rows = sorted((json.loads(line) for line in out.getvalue().splitlines()), key=lambda row: row['id'])
+        self.assertEqual(rows, [{'id': alpha.pk, 'name': 'alpha', 'v': '1', 'x': None},
+                                {'id': beta.pk, 'name': 'beta', 'v': '2', 'x': None}])
+        # keys are quoted as column names
+        out = StringIO()
+        DataBag.objects.filter(name='alpha').copy_to(out, format='jsonl', keys=['a"b', '%s'])
+        self.assertEqual(json.loads(out.getvalue()), {'id': alpha.pk, 'name': 'alpha', 'a"b': None, '%s': None})
+        out = StringIO()
+        child = ChildBag.objects.create(name='child', kind='k', data={'v': 1})
+        ChildBag.objects.copy_to(out, format='jsonl', keys=['v'])
+        self.assertEqual(json.loads(out.getvalue()),
+                         {'id': child.pk, 'name': 'child', 'databag_ptr_id': child.pk, 'kind': 'k', 'v': '1'})
+
+    def test_annotate_keys(self):
+        alpha, beta = self._create_bags()
+        r = DataBag.objects.annotate_keys(first=('data', 'v')).order_by('name').values_list('name', 'first')
+        self.assertEqual(list(r), [('alpha', '1'), ('beta', '2')])
+
+    def test_hvalues(self):
+        DataBag.objects.create(name='n', data={'a': 1, 'b': [2], 'c': 'x'})
+        self.assertEqual(list(DataBag.objects.filter(name='n').hvalues('data', ['a', 'b', 'd'], 'name')),
+                         [{'name': 'n', 'a': 1, 'b': [2], 'd': None}])
+
+    def test_hkeys_distinct(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'w': 'x'})
+        self.assertEqual(DataBag.objects.hkeys_distinct('data'), ['v', 'v2', 'w'])
+        self.assertEqual(DataBag.objects.hkeys_distinct('data', name='gamma'), ['w'])
+        self.assertEqual(DataBag.objects.hkeys_distinct('data', sample=100), ['v', 'v2', 'w'])
+
+    def test_key_catalog(self):
+        CatalogBag.objects.all().delete()
+        query.clear_key_catalogs()
+        CatalogBag.objects.create(name='a', data={'a': 1})
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a'])
+        CatalogBag.objects.create(name='b', data={'b': 1})
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a'])
+        self.assertEqual(CatalogBag.objects.filter(name='b').hkeys_distinct('data'), ['b'])
+        query.clear_key_catalogs()
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a', 'b'])
+
+    def test_key_aggregates(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': '2', 'w': 'x'})
+        self.assertEqual(DataBag.objects.hkey_counts('data'), [('v', 3), ('v2', 2), ('w', 1)])
+        self.assertEqual(DataBag.objects.hvalue_counts('data', 'v'), [(2, 2), (1, 1)])
+        self.assertEqual(DataBag.objects.exclude(name='gamma').hvalue_counts('data', 'w'), [])
+
+    def test_numeric_key_aggregates(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': 'none', 'v2': '5'})
+        self.assertEqual(DataBag.objects.hsum('data', 'v'), 3)
+        self.assertEqual(DataBag.objects.havg('data', 'v2'), Decimal(4))
+        self.assertEqual(DataBag.objects.hmin('data', 'v2'), 3)
+        self.assertEqual(DataBag.objects.filter(name='alpha').hmax('data', 'v'), 1)
+        self.assertEqual(DataBag.objects.hmax('data', 'missing'), None)
+
+    def test_hstore_oid_cache(self):
+        connection.close()
+        oids.clear_hstore_oids()
+        DataBag.objects.create(name='a', data={'v': 1})
+        cached = oids.get_hstore_oids(connection)
+        self.assertEqual(oids._hstore_oids, {oids.database_key(connection): cached})
+        connection.close()
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1})
+        self.assertTrue(oids.get_hstore_oids(connection) is cached)
+        # syncdb looks the OIDs up again
+        oids._hstore_oids[oids.database_key(connection)] = (0, 0)
+        call_command('syncdb', verbosity=0, interactive=False)
+        self.assertEqual(oids.get_hstore_oids(connection), cached)
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1})
+
+    def test_connection_pool(self):
+        settings_dict = dict(connection.settings_dict, POOL={'MAX_SIZE': 1})
+        wrapper = connections['default'].__class__(settings_dict, alias='pooled')
+        try:
+            wrapper.cursor().execute('SELECT 1')
+            raw = wrapper.connection
+            wrapper.close()
+            self.assertFalse(raw.closed)
+            cursor = wrapper.cursor()
+            self.assertTrue(wrapper.connection is raw)
+            cursor.execute("SELECT 'a=>1'::hstore")
+            self.assertEqual(cursor.fetchone()[0], {'a': '1'})
+            stats = wrapper.pool.stats()
+            self.assertEqual((stats['opened'], stats['reused'], stats['in_use']), (1, 1, 1))
+            wrapper.close()
+        finally:
+            wrapper.pool.close_all()
+        self.assertTrue(raw.closed)
+        self.assertEqual(wrapper.pool.stats()['idle'], 0)
+
+    def test_hdicts(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='list', data={'l': [1, 2]})
+        dicts = dict(DataBag.objects.hdicts('data'))
+        self.assertEqual(dicts[alpha.pk], {'v': 1, 'v2': 3})
+        self.assertEqual(dicts[DataBag.objects.get(name='list').pk], {'l': [1, 2]})
+        self.assertEqual(list(DataBag.objects.filter(name='beta').hdicts('data', decode=False)),
+                         [(beta.pk, {'v': '2', 'v2': '4'})])
+
+    def test_hremove(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        DataBag.objects.filter(name='alpha').hremove('data', 'v2')
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1'})
+
+        self.assertEqual(DataBag.objects.get(name='beta').data, beta.data)
+        DataBag.objects.filter(name='beta').hremove('data', ['v', 'v2'])
+        self.assertEqual(DataBag.objects.get(name='beta').data, {})
+
+    def test_hslice(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['v']), {'v': 1})
+        self.assertEqual(DataBag.objects.filter(id=alpha.id).hslice(attr='data', keys=['v']), {'v': 1})
+        self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['ggg']), {})
+
+    def test_hupdate(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        DataBag.objects.filter(name='alpha').hupdate('data', {'v2': '10', 'v3': '20'})
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '20'})
+
+    def test_bulk_hupdate(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v': '3'})
+        updates = {alpha.pk: {'v2': 10}, beta.pk: {'v': 'b', 'v3': [1]}, gamma.pk: {'v': 'c'}}
+        self.assertEqual(DataBag.objects.bulk_hupdate('data', updates, batch_size=2), 3)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 1, 'v2': 10})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 'b', 'v2': 4, 'v3': [1]})
+
+        rows = DataBag.objects.exclude(name='gamma').bulk_hupdate('data', {alpha.pk: {'v': 'a'}, gamma.pk: {'v': 'g'}})
+        self.assertEqual(rows, 1)
+        self.assertEqual(DataBag.objects.get(name='gamma').data, {'v': 'c'})
+
+    def test_bulk_hremove(self):
+        alpha, beta = self._create_bags()
+        rows = DataBag.objects.bulk_hremove('data', {alpha.pk: 'v', beta.pk: ['v', 'v2']})
+        self.assertEqual(rows, 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v2': 3})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {})
+
+    def test_copy_from(self):
+        text = u'say "hi"\\\t\n\u00e9'
+        rows = [{'name': 'a', 'data': {'v': 1, 'text': text}}, DataBag(name='b', data={'l': [1, 2]}), {'name': 'c'}]
+        self.assertEqual(DataBag.objects.copy_from(iter(rows), chunk_size=2), 3)
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1, 'text': text})
+        self.assertEqual(DataBag.objects.get(name='b').data, {'l': [1, 2]})
+        self.assertEqual(DataBag.objects.get(name='c').data, {})
+        self.assertEqual(DataBag.objects.copy_from([('d', {'w': 'x'})], fields=['name', 'data']), 1)
+
+        # defaults are evaluated and auto_now_add fields set for every row
+        UniqueBag.objects.all().delete()
+        self.assertEqual(UniqueBag.objects.copy_from([{'name': 'a'}, {'name': 'b'}, UniqueBag(name='c')]), 3)
+        bags = UniqueBag.objects.all()
+        self.assertEqual(len(set(bag.token for bag in bags)), 3)
+        self.assertTrue(all(bag.created for bag in bags))
+
+    def test_hupsert(self):
+        UniqueBag.objects.all().delete()
+        UniqueBag.objects.create(name='a', data={'v': 1, 'w': 2})
+        UniqueBag.objects.create(name='c')
+        count = UniqueBag.objects.hupsert('name', 'data', {'a': {'v': 3}, 'b': {'v': 4}, 'c': {'v': 5}, 'd': {}},
+                                          defaults={'kind': 'new'}, batch_size=2)
+        self.assertEqual(count, 4)
+        bags = dict((bag.name, (bag.kind, bag.data)) for bag in UniqueBag.objects.all())
+        self.assertEqual(bags, {'a': ('plain', {'v': 3, 'w': 2}), 'b': ('new', {'v': 4}), 'c': ('plain', {'v': 5}),
+                                'd': ('new', {})})
+        # created rows have their own token and creation time
+        created = UniqueBag.objects.filter(name__in=['b', 'd'])
+        self.assertEqual(len(set(bag.token for bag in created)), 2)
+        self.assertTrue(all(bag.created for bag in created))
+        # updates by lookup values coerced by the field
+        self.assertEqual(UniqueBag.objects.hupsert('name', 'data', {u'\xe9': {'v': 1}}), 1)
+        self.assertEqual(UniqueBag.objects.hupsert('name', 'data', {'\xc3\xa9': {'w': 2}}), 1)
+        self.assertEqual(UniqueBag.objects.get(name=u'\xe9').data, {'v': 1, 'w': 2})
+
+    def test_queued_remove(self):
+        alpha, beta = self._create_bags()
+        with hstore.RemovalQueue() as queue:
+            alpha.data.remove('v', queue=queue)
+            alpha.data.remove(['v2'], queue=queue)
+            beta.data.remove('v2', queue=queue)
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 2})
+
+    def test_save_changes(self):
+        alpha, beta = self._create_bags()
+        alpha = DataBag.objects.get(name='alpha')
+        self.assertFalse(alpha.data.has_changes())
+        self.assertEqual(alpha.data.save_changes(), 0)
+
+        # concurrent write to a key which is not touched locally
+        DataBag.objects.filter(name='alpha').hupdate('data', {'other': '"x"'})
+        alpha.data['v'] = 5
+        del alpha.data['v2']
+        alpha.data.update(n=[1])
+        self.assertTrue(alpha.data.has_changes())
+        self.assertEqual(alpha.data.save_changes(), 1)
+        self.assertFalse(alpha.data.has_changes())
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 5, 'n': [1], 'other': 'x'})
+
+    def test_save_resets_changes(self):
+        alpha, beta = self._create_bags()
+        alpha = DataBag.objects.get(name='alpha')
+        alpha.data['v'] = 5
+        alpha.save()
+        self.assertFalse(alpha.data.has_changes())
+
+        # a concurrent write to a key saved above is not overwritten
+        DataBag.objects.filter(name='alpha').hupdate('data', {'v': '6'})
+        alpha.data['n'] = 1
+        self.assertEqual(alpha.data.save_changes(), 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 6, 'v2': 3, 'n': 1})
+
+    def test_batch(self):
+        alpha, beta = self._create_bags()
+        with DataBag.objects.get_query_set().batch() as batch:
+            first = DataBag.objects.filter(name='alpha').hupdate('data', {'v3': '"3"'})
+            DataBag.objects.filter(name='alpha').hremove('data', 'v')
+            DataBag.objects.filter(name__in=['alpha', 'beta']).hupdate('data', {'v4': '4'})
+            DataBag.objects.filter(name='alpha').hupdate('data', {'v': '"a"'})
+            self.assertEqual(first.rows, None)
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        self.assertEqual(batch.results, [1, 1, 2, 1])
+        self.assertEqual(first.rows, 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 'a', 'v2': 3, 'v3': '3', 'v4': 4})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 2, 'v2': 4, 'v4': 4})
+
+    def test_batch_order(self):
+        self._create_bags()
+        with hstore.HStoreBatch():
+            DataBag.objects.filter(name='alpha').hupdate('data', {'k': '1'})
+            DataBag.objects.filter(name__in=['alpha', 'beta']).hupdate('data', {'k': '2'})
+            DataBag.objects.filter(name='alpha').hupdate('data', {'k': '3'})
+        self.assertEqual(DataBag.objects.get(name='alpha').data['k'], 3)
+        self.assertEqual(DataBag.objects.get(name='beta').data['k'], 2)
+
+    def test_location_create(self):
+        l1, l2 = self._create_locations()
+        other_loc = Location.objects.get(point__contains=self.pnt1)
+        self.assertEqual(other_loc.data, {'prop1': '1', 'prop2': 'test_value'})
+
+    def test_location_hupdate(self):
+        l1, l2 = self._create_locations()
+        Location.objects.filter(point__contains=self.pnt1).hupdate('data', {'prop1': '2'})
+        loc = Location.objects.exclude(point__contains=self.pnt2)[0]
+        self.assertEqual(loc.data, {'prop1': '2', 'prop2': 'test_value'})
+        loc = Location.objects.get(point__contains=self.pnt2)
+        self.assertNotEqual(loc.data, {'prop1': '1', 'prop2': 'test_value'})
+    
+    def test_location_contains(self):
+        l1, l2 = self._create_locations()
+        self.assertEqual(Location.objects.filter(data__contains={'prop1': '1'}).count(), 1)
+        self.assertEqual(Location.objects.filter(data__contains={'prop1': '2'}).count(), 1)
+    
+    def test_location_geomanager(self):
+        l1, l2 = self._create_locations()
+        d1 = Location.objects.filter(point__distance_lte=(self.pnt1, 70000))
+        self.assertEqual(d1.count(), 2)
+    
+    def test_default(self):
+        m = DefaultsModel()
+        m.save()
+
+    def test_bad_default(self):
+        m = BadDefaultsModel()
+        try:
+            m.save()
+        except IntegrityError:
+            transaction.rollback()
+        else:
+            self.assertTrue(False)
+
+    def test_serialization_deserialization(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(json.loads(str(DataBag.objects.get(name='alpha').data)), json.loads(str(alpha.data)))
+        self.assertEqual(json.loads(str(DataBag.objects.get(name='beta').data)), json.loads(str(beta.data)))
+
+
+class TestReferencesField(TestCase):
+    pnt1 = GEOSGeometry('POINT(65.5758316 57.1345383)')
+    pnt2 = GEOSGeometry('POINT(65.2316 57.3423233)')
+
+    def setUp(self):
+        Ref.objects.all().delete()
+        RefsBag.objects.all().delete()
+        Location.objects.all().delete()
+
+    def _create_bags(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(4)]
+        alpha = RefsBag.objects.create(name='alpha', refs={'0': refs[0], '1': refs[1]})
+        beta = RefsBag.objects.create(name='beta', refs={'0': refs[2], '1': refs[3]})
+        return alpha, beta, refs
+
+    def _create_locations(self):
+        loc1 = Location.objects.create(name='Location1', data={'prop1': '1', 'prop2': 'test_value'}, point=self.pnt1)
+        loc2 = Location.objects.create(name='Location2', data={'prop1': '2', 'prop2': 'test_value'}, point=self.pnt2)
+        return loc1, loc2
+
+    def test_empty_instantiation(self):
+        bag = RefsBag.objects.create(name='bag')
+        self.assertTrue(isinstance(bag.refs, dict))
+        self.assertEqual(bag.refs, {})
+    
+    def test_unsaved_empty_instantiation(self):
+        bag = RefsBag(name='bag')
+        self.assertEqual(bag.refs.get('idontexist', 'default'), 'default')
+        self.assertTrue(isinstance(bag.refs, dict))
+    
+    def test_unsave_empty_instantiation_of_nullable_ref(self):
+        bag = NullableRefsBag(name='bag')
+        self.assertEqual(bag.refs.get('idontexist', 'default'), 'default')
+        self.assertTrue(isinstance(bag.refs, dict))
+    
+    def test_simple_retrieval(self):
+        alpha, beta, refs = self._create_bags()
+        alpha = RefsBag.objects.get(name='alpha')
+        self.assertEqual(Ref.objects.get(name='0'), alpha.refs['0'])
+    
+    def test_simple_retrieval_get(self):
+        alpha, beta, refs = self._create_bags()
+        alpha = RefsBag.objects.get(name='alpha')
+        self.assertEqual(Ref.objects.get(name='0'), alpha.refs.get('0'))
+        
+        # try getting a non existent key
+        self.assertEqual(alpha.refs.get('idontexist', 'default'), 'default')
+        self.assertEqual(alpha.refs.get('idontexist'), None)
+
+    def test_prefetch_references(self):
+        alpha, beta, refs = self._create_bags()
+        bags = list(RefsBag.objects.prefetch_references('refs').order_by('name'))
+        self.assertEqual(dict.__getitem__(bags[0].refs, '0'), refs[0])
+        self.assertEqual(dict.__getitem__(bags[1].refs, '1'), refs[3])
+        self.assertEqual(bags[0].refs['1'], refs[1])
+
+        Ref.objects.filter(pk=refs[2].pk).delete()
+        beta = RefsBag.objects.prefetch_references('refs').get(name='beta')
+        self.assertEqual(beta.refs['0'], None)
+        self.assertRaises(ValueError, RefsBag.objects.prefetch_references, 'name')
+
+    def test_reference_cache(self):
+        ref = Ref.objects.create(name='cached')
+        reference = util.identify_instance(ref)
+        self.assertEqual(util.acquire_reference(reference), ref)
+        util.clear_reference_cache()
+        self.assertEqual(util.identify_instance(ref), reference)
+        self.assertEqual(util.acquire_reference(reference), ref)
+
+    @skipUnless(os.environ.get('HSTORE_BENCHMARK'), 'set HSTORE_BENCHMARK to run the benchmarks')
+    def test_reference_resolution_benchmark(self):
+        ref = Ref.objects.create(name='bench')
+        reference = util.identify_instance(ref)
+
+        def timing(cold):
+            def resolve():
+                if cold:
+                    util.clear_reference_cache()
+                util.acquire_reference(util.identify_instance(ref))
+            return min(timeit.repeat(resolve, number=200, repeat=3)) / 200
+
+        cold, warm = timing(True), timing(False)
+        sys.stderr.write('\nreference resolution: %.1fus with empty registries, %.1fus cached\n' % (
+            cold * 1e6, warm * 1e6))
+
+    def test_empty_querying(self):
+        DataBag.objects.create(name='bag')
+        self.assertTrue(DataBag.objects.get(data={}))
+        self.assertTrue(DataBag.objects.filter(data={}))
+        self.assertTrue(DataBag.objects.filter(data__contains={}))
+
+    def test_named_querying(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.get(name='alpha'), alpha)
+        self.assertEqual(DataBag.objects.filter(name='beta')[0], beta)
+
+    def test_aggregates(self):
+        self._create_bitfield_bags()
+
+        self.assertEqual(DataBag.objects.filter(data__contains={'b0': '1'}).aggregate(Count('id'))['id__count'], 5)
+        self.assertEqual(DataBag.objects.filter(data__contains={'b1': '1'}).aggregate(Count('id'))['id__count'], 4)
+
+    def test_annotations(self):
+        self._create_bitfield_bags()
+
+        self.assertEqual(DataBag.objects.annotate(num_id=Count('id')).filter(num_id=1)[0].num_id, 1)
+
+    def test_nested_filtering(self):
+        self._create_bitfield_bags()
+
+        # Test cumulative successive filters for both dictionaries and other fields
+        f = DataBag.objects.all()
+        self.assertEqual(10, f.count())
+        f = f.filter(data__contains={'b0': '1'})
+        self.assertEqual(5, f.count())
+        f = f.filter(data__contains={'b1': '1'})
+        self.assertEqual(2, f.count())
+        f = f.filter(name='bag3')
+        self.assertEqual(1, f.count())
+
+    def test_unicode_processing(self):
+        greets = {
+            u'de': u'Gr\xfc\xdfe, Welt',
+            u'en': u'hello, world',
+            u'es': u'hola, ma\xf1ana',
+            u'he': u'\u05e9\u05dc\u05d5\u05dd, \u05e2\u05d5\u05dc\u05dd',
+            u'jp': u'\u3053\u3093\u306b\u3061\u306f\u3001\u4e16\u754c',
+            u'zh': u'\u4f60\u597d\uff0c\u4e16\u754c',
+        }
+        DataBag.objects.create(name='multilang', data=greets)
+        self.assertEqual(greets, DataBag.objects.get(name='multilang').data)
+
+    def test_query_escaping(self):
+        me = self
+
+        def readwrite(s):
+            # try create and query with potentially illegal characters in the field and dictionary key/value
+            o = DataBag.objects.create(name=s, data={s: s})
+            me.assertEqual(o, DataBag.objects.get(name=s, data={s: s}))
+        readwrite('\' select')
+        readwrite('% select')
+        readwrite('\\\' select')
+        readwrite('-- select')
+        readwrite('\n select')
+        readwrite('\r select')
+        readwrite('* select')
+
+    def test_replace_full_dictionary(self):
+        DataBag.objects.create(name='foo', data={'change': 'old value', 'remove': 'baz'})
+
+        replacement = {'change': 'new value', 'added': 'new'}
+        DataBag.objects.filter(name='foo').update(data=replacement)
+        self.assertEqual(replacement, DataBag.objects.get(name='foo').data)
+
+    def test_equivalence_querying(self):
+        alpha, beta = self._create_bags()
+        for bag in (alpha, beta):
+            data = {'v': bag.data['v'], 'v2': bag.data['v2']}
+            self.assertEqual(DataBag.objects.get(data=data), bag)
+            r = DataBag.objects.filter(data=data)
+            self.assertEqual(len(r), 1)
+            self.assertEqual(r[0], bag)
+
+    def test_key_value_subset_querying(self):
+        alpha, beta = self._create_bags()
+        for bag in (alpha, beta):
+            r = DataBag.objects.filter(data__contains={'v': bag.data['v']})
+            self.assertEqual(len(r), 1)
+            self.assertEqual(r[0], bag)
+            r = DataBag.objects.filter(data__contains={'v': bag.data['v'], 'v2': bag.data['v2']})
+            self.assertEqual(len(r), 1)
+            self.assertEqual(r[0], bag)
+
+    def test_value_in_subset_querying(self):
+        alpha, beta = self._create_bags()
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v']]})
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0], alpha)
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v'], beta.data['v']]})
+        self.assertEqual(len(r), 2)
+        self.assertEqual(set(r), set([alpha, beta]))
+
+        # int values are ok
+        r = DataBag.objects.filter(data__contains={'v': [int(alpha.data['v'])]})
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0], alpha)
+
+    def test_multiple_key_value_in_subset_querying(self):
+        alpha, beta = self._create_bags()
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v'], beta.data['v']], 'v2': [beta.data['v2']]})
+        self.assertEqual(list(r), [beta])
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v'], beta.data['v']], 'v2': str(alpha.data['v2'])})
+        self.assertEqual(list(r), [alpha])
+        r = DataBag.objects.filter(data__contains={'v': [alpha.data['v']], 'v2': [beta.data['v2']]})
+        self.assertEqual(r.count(), 0)
+
+    def test_compiled_atom_cache(self):
+        alpha, beta = self._create_bags()
+        query.clear_atom_cache()
+        self.assertEqual(DataBag.objects.filter(data__contains={'v': '1'}).count(), 1)
+        self.assertEqual(query.atom_cache_info()['misses'], 1)
+        self.assertEqual(DataBag.objects.filter(data__contains={'v': '2'}).count(), 1)
+        info = query.atom_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+        DataBag.objects.filter(data__contains={'v': ['1']}).count()
+        self.assertEqual(query.atom_cache_info()['misses'], 2)
+
     def test_key_value_gt_querying(self):
         alpha, beta = self._create_bags()
         self.assertGreater(beta.data['v'], alpha.data['v'])
@@ -181,6 +889,44 @@ class TestDictionaryField(TestCase):
         r = DataBag.objects.filter(data__gte={'v': alpha.data['v']})
         self.assertEqual(len(r), 2)
 
+    def test_numeric_range_querying(self):
+        DataBag.objects.create(name='cheap', data={'price': 9})
+        DataBag.objects.create(name='dear', data={'price': 10.5})
+        DataBag.objects.create(name='free', data={'price': 'none'})
+        self.assertEqual([b.name for b in DataBag.objects.filter(data__gt={'price': 9})], ['dear'])
+        self.assertEqual(DataBag.objects.filter(data__gte={'price': 9}).count(), 2)
+        self.assertEqual([b.name for b in DataBag.objects.filter(data__lt={'price': 10})], ['cheap'])
+
+    def test_key_index_sql(self):
+        sql = query.key_index_sql(DataBag, 'data', 'price', numeric=True)
+        self.assertTrue(sql.startswith('CREATE INDEX'))
+        self.assertTrue(query.numeric_key_sql('"data"', 'price') in sql)
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        cursor.execute('DROP INDEX %s' % sql.split()[2])
+
+    def test_indexed_keys(self):
+        field = IndexedBag._meta.get_field_by_name('data')[0]
+        sql = connection.creation.sql_indexes_for_field(IndexedBag, field, no_style())
+        self.assertEqual(len(sql), 3)
+        self.assertTrue('USING GIN' in sql[0])
+        self.assertEqual(sql[1], query.key_index_sql(IndexedBag, 'data', 'status'))
+        self.assertEqual(sql[2], query.key_index_sql(IndexedBag, 'data', 'price', numeric=True))
+
+        IndexedBag.objects.create(name='a', data={'status': 'new', 'price': 5})
+        IndexedBag.objects.create(name='b', data={'status': 'old', 'price': 50})
+        self.assertEqual(IndexedBag.objects.get(data__contains={'status': '"new"'}).name, 'a')
+        self.assertEqual(IndexedBag.objects.get(data__contains={'status': '"old"', 'price': '50'}).name, 'b')
+        self.assertEqual(IndexedBag.objects.get(data__gt={'price': 10}).name, 'b')
+        self.assertRaises(ValueError, list, IndexedBag.objects.filter(data__gt={'price': 'ten'}))
+
+    def test_hstore_indexes_command(self):
+        out = StringIO()
+        call_command('hstore_indexes', stdout=out)
+        report = out.getvalue()
+        self.assertTrue('django_hstore_tests_indexedbag.data: declared gin, found django_hstore_tests_indexedbag_data_gin (gin), ok' in report)
+        self.assertFalse('mismatch' in report)
+
     def test_key_value_lt_querying(self):
         alpha, beta = self._create_bags()
         self.assertLess(alpha.data['v'], beta.data['v'])
@@ -204,6 +950,24 @@ class TestDictionaryField(TestCase):
         for key in ('n1', 'n2'):
             self.assertEqual(DataBag.objects.filter(data__contains=[key]).count(), 0)
     
+    def test_key_existence_querying(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v3': '1'})
+        self.assertEqual(DataBag.objects.filter(data__has_key='v').count(), 2)
+        self.assertEqual(DataBag.objects.filter(data__has_any_keys=['v2', 'v3']).count(), 3)
+        self.assertEqual(DataBag.objects.filter(data__has_any_keys=['n1', 'v3']).get(), gamma)
+        self.assertEqual(DataBag.objects.filter(data__has_all_keys=['v', 'v2']).count(), 2)
+        self.assertEqual(DataBag.objects.filter(data__has_all_keys=['v', 'v3']).count(), 0)
+
+    def test_not_contains_querying(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.filter(data__not_contains={'v': '1'}).get(), beta)
+        self.assertEqual(DataBag.objects.filter(data__not_contains='v').count(), 0)
+        self.assertEqual(DataBag.objects.filter(data__not_contains=['v', 'n1']).count(), 2)
+        hello = DataBag.objects.create(name='hello', data={'w': 'hello'})
+        self.assertEqual(DataBag.objects.get(data__contains={'w': '"hello"'}), hello)
+        self.assertEqual(DataBag.objects.filter(data__not_contains={'w': '"hello"'}).count(), 2)
+
     def test_simple_text_icontains_querying(self):
         alpha, beta = self._create_bags()
         gamma = DataBag.objects.create(name='gamma', data={'theKey': 'someverySpecialValue', 'v2': '3'})
@@ -225,10 +989,144 @@ class TestDictionaryField(TestCase):
 
     def test_hpeek(self):
         alpha, beta = self._create_bags()
-        self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='v'), '1')
-        self.assertEqual(DataBag.objects.filter(id=alpha.id).hpeek(attr='data', key='v'), '1')
+        self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='v'), 1)
+        self.assertEqual(DataBag.objects.filter(id=alpha.id).hpeek(attr='data', key='v'), 1)
         self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='invalid'), None)
 
+    def test_hpeek_values(self):
+        alpha, beta = self._create_bags()
+        values = DataBag.objects.filter(name__in=['alpha', 'beta']).hpeek_values('data', 'v', chunk_size=1)
+        self.assertEqual(sorted(values), sorted([(alpha.pk, 1), (beta.pk, 2)]))
+        self.assertEqual(list(DataBag.objects.hpeek_values('data', 'invalid', name='alpha')), [(alpha.pk, None)])
+
+    def test_hslice_values(self):
+        alpha, beta = self._create_bags()
+        values = DataBag.objects.hslice_values('data', ['v', 'ggg'])
+        self.assertEqual(sorted(values), sorted([(alpha.pk, {'v': 1}), (beta.pk, {'v': 2})]))
+
+    def test_stream(self):
+        alpha, beta = self._create_bags()
+        bags = list(DataBag.objects.order_by('name').stream(chunk_size=1))
+        self.assertEqual(bags, [alpha, beta])
+        self.assertEqual(bags[1].data, beta.data)
+        rows = list(DataBag.objects.stream(raw=True, name='alpha'))
+        self.assertEqual(rows, [{'id': alpha.pk, 'name': 'alpha', 'data': {'v': '1', 'v2': '3'}}])
+        # the fields of parent models come from their table
+        child = ChildBag.objects.create(name='child', kind='k', data={'v': 1})
+        self.assertEqual([(bag.pk, bag.name, bag.kind, bag.data) for bag in ChildBag.objects.stream()],
+                         [(child.pk, 'child', 'k', {'v': 1})])
+
+    def test_copy_to(self):
+        alpha, beta = self._create_bags()
+        out = StringIO()
+        DataBag.objects.filter(name='alpha').copy_to(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,name,data')
+        self.assertEqual(lines[1].split(',')[:2], [str(alpha.pk), 'alpha'])
+        self.assertEqual(len(lines), 2)
+        out = StringIO()
+        DataBag.objects.copy_to(out, format='jsonl', keys=['v', 'x'])
+        rows = sorted((json.loads(line) for line in out.getvalue().splitlines()), key=lambda row: row['id'])
+        self.assertEqual(rows, [{'id': alpha.pk, 'name': 'alpha', 'v': '1', 'x': None},
+                                {'id': beta.pk, 'name': 'beta', 'v': '2', 'x': None}])
+        # keys are quoted as column names
+        out = StringIO()
+        DataBag.objects.filter(name='alpha').copy_to(out, format='jsonl', keys=['a"b', '%s'])
+        self.assertEqual(json.loads(out.getvalue()), {'id': alpha.pk, 'name': 'alpha', 'a"b': None, '%s': None})
+        out = StringIO()
+        child = ChildBag.objects.create(name='child', kind='k', data={'v': 1})
+        ChildBag.objects.copy_to(out, format='jsonl', keys=['v'])
+        self.assertEqual(json.loads(out.getvalue()),
+                         {'id': child.pk, 'name': 'child', 'databag_ptr_id': child.pk, 'kind': 'k', 'v': '1'})
+
+    def test_annotate_keys(self):
+        alpha, beta = self._create_bags()
+        r = DataBag.objects.annotate_keys(first=('data', 'v')).order_by('name').values_list('name', 'first')
+        self.assertEqual(list(r), [('alpha', '1'), ('beta', '2')])
+
+    def test_hvalues(self):
+        DataBag.objects.create(name='n', data={'a': 1, 'b': [2], 'c': 'x'})
+        self.assertEqual(list(DataBag.objects.filter(name='n').hvalues('data', ['a', 'b', 'd'], 'name')),
+                         [{'name': 'n', 'a': 1, 'b': [2], 'd': None}])
+
+    def test_hkeys_distinct(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'w': 'x'})
+        self.assertEqual(DataBag.objects.hkeys_distinct('data'), ['v', 'v2', 'w'])
+        self.assertEqual(DataBag.objects.hkeys_distinct('data', name='gamma'), ['w'])
+        self.assertEqual(DataBag.objects.hkeys_distinct('data', sample=100), ['v', 'v2', 'w'])
+
+    def test_key_catalog(self):
+        CatalogBag.objects.all().delete()
+        query.clear_key_catalogs()
+        CatalogBag.objects.create(name='a', data={'a': 1})
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a'])
+        CatalogBag.objects.create(name='b', data={'b': 1})
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a'])
+        self.assertEqual(CatalogBag.objects.filter(name='b').hkeys_distinct('data'), ['b'])
+        query.clear_key_catalogs()
+        self.assertEqual(CatalogBag.objects.hkeys_distinct('data'), ['a', 'b'])
+
+    def test_key_aggregates(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': '2', 'w': 'x'})
+        self.assertEqual(DataBag.objects.hkey_counts('data'), [('v', 3), ('v2', 2), ('w', 1)])
+        self.assertEqual(DataBag.objects.hvalue_counts('data', 'v'), [(2, 2), (1, 1)])
+        self.assertEqual(DataBag.objects.exclude(name='gamma').hvalue_counts('data', 'w'), [])
+
+    def test_numeric_key_aggregates(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': 'none', 'v2': '5'})
+        self.assertEqual(DataBag.objects.hsum('data', 'v'), 3)
+        self.assertEqual(DataBag.objects.havg('data', 'v2'), Decimal(4))
+        self.assertEqual(DataBag.objects.hmin('data', 'v2'), 3)
+        self.assertEqual(DataBag.objects.filter(name='alpha').hmax('data', 'v'), 1)
+        self.assertEqual(DataBag.objects.hmax('data', 'missing'), None)
+
+    def test_hstore_oid_cache(self):
+        connection.close()
+        oids.clear_hstore_oids()
+        DataBag.objects.create(name='a', data={'v': 1})
+        cached = oids.get_hstore_oids(connection)
+        self.assertEqual(oids._hstore_oids, {oids.database_key(connection): cached})
+        connection.close()
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1})
+        self.assertTrue(oids.get_hstore_oids(connection) is cached)
+        # syncdb looks the OIDs up again
+        oids._hstore_oids[oids.database_key(connection)] = (0, 0)
+        call_command('syncdb', verbosity=0, interactive=False)
+        self.assertEqual(oids.get_hstore_oids(connection), cached)
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1})
+
+    def test_connection_pool(self):
+        settings_dict = dict(connection.settings_dict, POOL={'MAX_SIZE': 1})
+        wrapper = connections['default'].__class__(settings_dict, alias='pooled')
+        try:
+            wrapper.cursor().execute('SELECT 1')
+            raw = wrapper.connection
+            wrapper.close()
+            self.assertFalse(raw.closed)
+            cursor = wrapper.cursor()
+            self.assertTrue(wrapper.connection is raw)
+            cursor.execute("SELECT 'a=>1'::hstore")
+            self.assertEqual(cursor.fetchone()[0], {'a': '1'})
+            stats = wrapper.pool.stats()
+            self.assertEqual((stats['opened'], stats['reused'], stats['in_use']), (1, 1, 1))
+            wrapper.close()
+        finally:
+            wrapper.pool.close_all()
+        self.assertTrue(raw.closed)
+        self.assertEqual(wrapper.pool.stats()['idle'], 0)
+
+    def test_hdicts(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='list', data={'l': [1, 2]})
+        dicts = dict(DataBag.objects.hdicts('data'))
+        self.assertEqual(dicts[alpha.pk], {'v': 1, 'v2': 3})
+        self.assertEqual(dicts[DataBag.objects.get(name='list').pk], {'l': [1, 2]})
+        self.assertEqual(list(DataBag.objects.filter(name='beta').hdicts('data', decode=False)),
+                         [(beta.pk, {'v': '2', 'v2': '4'})])
+
     def test_hremove(self):
         alpha, beta = self._create_bags()
         self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
@@ -241,8 +1139,8 @@ class TestDictionaryField(TestCase):
 
     def test_hslice(self):
         alpha, beta = self._create_bags()
-        self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['v']), {'v': '1'})
-        self.assertEqual(DataBag.objects.filter(id=alpha.id).hslice(attr='data', keys=['v']), {'v': '1'})
+        self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['v']), {'v': 1})
+        self.assertEqual(DataBag.objects.filter(id=alpha.id).hslice(attr='data', keys=['v']), {'v': 1})
         self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['ggg']), {})
 
     def test_hupdate(self):
@@ -251,6 +1149,122 @@ class TestDictionaryField(TestCase):
         DataBag.objects.filter(name='alpha').hupdate('data', {'v2': '10', 'v3': '20'})
         self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '20'})
 
+    def test_bulk_hupdate(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v': '3'})
+        updates = {alpha.pk: {'v2': 10}, beta.pk: {'v': 'b', 'v3': [1]}, gamma.pk: {'v': 'c'}}
+        self.assertEqual(DataBag.objects.bulk_hupdate('data', updates, batch_size=2), 3)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 1, 'v2': 10})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 'b', 'v2': 4, 'v3': [1]})
+
+        rows = DataBag.objects.exclude(name='gamma').bulk_hupdate('data', {alpha.pk: {'v': 'a'}, gamma.pk: {'v': 'g'}})
+        self.assertEqual(rows, 1)
+        self.assertEqual(DataBag.objects.get(name='gamma').data, {'v': 'c'})
+
+    def test_bulk_hremove(self):
+        alpha, beta = self._create_bags()
+        rows = DataBag.objects.bulk_hremove('data', {alpha.pk: 'v', beta.pk: ['v', 'v2']})
+        self.assertEqual(rows, 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v2': 3})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {})
+
+    def test_copy_from(self):
+        text = u'say "hi"\\\t\n\u00e9'
+        rows = [{'name': 'a', 'data': {'v': 1, 'text': text}}, DataBag(name='b', data={'l': [1, 2]}), {'name': 'c'}]
+        self.assertEqual(DataBag.objects.copy_from(iter(rows), chunk_size=2), 3)
+        self.assertEqual(DataBag.objects.get(name='a').data, {'v': 1, 'text': text})
+        self.assertEqual(DataBag.objects.get(name='b').data, {'l': [1, 2]})
+        self.assertEqual(DataBag.objects.get(name='c').data, {})
+        self.assertEqual(DataBag.objects.copy_from([('d', {'w': 'x'})], fields=['name', 'data']), 1)
+
+        # defaults are evaluated and auto_now_add fields set for every row
+        UniqueBag.objects.all().delete()
+        self.assertEqual(UniqueBag.objects.copy_from([{'name': 'a'}, {'name': 'b'}, UniqueBag(name='c')]), 3)
+        bags = UniqueBag.objects.all()
+        self.assertEqual(len(set(bag.token for bag in bags)), 3)
+        self.assertTrue(all(bag.created for bag in bags))
+
+    def test_hupsert(self):
+        UniqueBag.objects.all().delete()
+        UniqueBag.objects.create(name='a', data={'v': 1, 'w': 2})
+        UniqueBag.objects.create(name='c')
+        count = UniqueBag.objects.hupsert('name', 'data', {'a': {'v': 3}, 'b': {'v': 4}, 'c': {'v': 5}, 'd': {}},
+                                          defaults={'kind': 'new'}, batch_size=2)
+        self.assertEqual(count, 4)
+        bags = dict((bag.name, (bag.kind, bag.data)) for bag in UniqueBag.objects.all())
+        self.assertEqual(bags, {'a': ('plain', {'v': 3, 'w': 2}), 'b': ('new', {'v': 4}), 'c': ('plain', {'v': 5}),
+                                'd': ('new', {})})
+        # created rows have their own token and creation time
+        created = UniqueBag.objects.filter(name__in=['b', 'd'])
+        self.assertEqual(len(set(bag.token for bag in created)), 2)
+        self.assertTrue(all(bag.created for bag in created))
+        # updates by lookup values coerced by the field
+        self.assertEqual(UniqueBag.objects.hupsert('name', 'data', {u'\xe9': {'v': 1}}), 1)
+        self.assertEqual(UniqueBag.objects.hupsert('name', 'data', {'\xc3\xa9': {'w': 2}}), 1)
+        self.assertEqual(UniqueBag.objects.get(name=u'\xe9').data, {'v': 1, 'w': 2})
+
+    def test_queued_remove(self):
+        alpha, beta = self._create_bags()
+        with hstore.RemovalQueue() as queue:
+            alpha.data.remove('v', queue=queue)
+            alpha.data.remove(['v2'], queue=queue)
+            beta.data.remove('v2', queue=queue)
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 2})
+
+    def test_save_changes(self):
+        alpha, beta = self._create_bags()
+        alpha = DataBag.objects.get(name='alpha')
+        self.assertFalse(alpha.data.has_changes())
+        self.assertEqual(alpha.data.save_changes(), 0)
+
+        # concurrent write to a key which is not touched locally
+        DataBag.objects.filter(name='alpha').hupdate('data', {'other': '"x"'})
+        alpha.data['v'] = 5
+        del alpha.data['v2']
+        alpha.data.update(n=[1])
+        self.assertTrue(alpha.data.has_changes())
+        self.assertEqual(alpha.data.save_changes(), 1)
+        self.assertFalse(alpha.data.has_changes())
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 5, 'n': [1], 'other': 'x'})
+
+    def test_save_resets_changes(self):
+        alpha, beta = self._create_bags()
+        alpha = DataBag.objects.get(name='alpha')
+        alpha.data['v'] = 5
+        alpha.save()
+        self.assertFalse(alpha.data.has_changes())
+
+        # a concurrent write to a key saved above is not overwritten
+        DataBag.objects.filter(name='alpha').hupdate('data', {'v': '6'})
+        alpha.data['n'] = 1
+        self.assertEqual(alpha.data.save_changes(), 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 6, 'v2': 3, 'n': 1})
+
+    def test_batch(self):
+        alpha, beta = self._create_bags()
+        with DataBag.objects.get_query_set().batch() as batch:
+            first = DataBag.objects.filter(name='alpha').hupdate('data', {'v3': '"3"'})
+            DataBag.objects.filter(name='alpha').hremove('data', 'v')
+            DataBag.objects.filter(name__in=['alpha', 'beta']).hupdate('data', {'v4': '4'})
+            DataBag.objects.filter(name='alpha').hupdate('data', {'v': '"a"'})
+            self.assertEqual(first.rows, None)
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        self.assertEqual(batch.results, [1, 1, 2, 1])
+        self.assertEqual(first.rows, 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': 'a', 'v2': 3, 'v3': '3', 'v4': 4})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': 2, 'v2': 4, 'v4': 4})
+
+    def test_batch_order(self):
+        self._create_bags()
+        with hstore.HStoreBatch():
+            DataBag.objects.filter(name='alpha').hupdate('data', {'k': '1'})
+            DataBag.objects.filter(name__in=['alpha', 'beta']).hupdate('data', {'k': '2'})
+            DataBag.objects.filter(name='alpha').hupdate('data', {'k': '3'})
+        self.assertEqual(DataBag.objects.get(name='alpha').data['k'], 3)
+        self.assertEqual(DataBag.objects.get(name='beta').data['k'], 2)
+
     def test_location_create(self):
         l1, l2 = self._create_locations()
         other_loc = Location.objects.get(point__contains=self.pnt1)
@@ -342,6 +1356,39 @@ class TestReferencesField(TestCase):
         self.assertEqual(alpha.refs.get('idontexist', 'default'), 'default')
         self.assertEqual(alpha.refs.get('idontexist'), None)
 
+    def test_prefetch_references(self):
+        alpha, beta, refs = self._create_bags()
+        bags = list(RefsBag.objects.prefetch_references('refs').order_by('name'))
+        self.assertEqual(dict.__getitem__(bags[0].refs, '0'), refs[0])
+        self.assertEqual(dict.__getitem__(bags[1].refs, '1'), refs[3])
+        self.assertEqual(bags[0].refs['1'], refs[1])
+
+        Ref.objects.filter(pk=refs[2].pk).delete()
+        beta = RefsBag.objects.prefetch_references('refs').get(name='beta')
+        self.assertEqual(beta.refs['0'], None)
+        self.assertRaises(ValueError, RefsBag.objects.prefetch_references, 'name')
+
+    def test_reference_resolution_benchmark(self):
+        ref = Ref.objects.create(name='bench')
+        implementation = util.identify_instance(ref).split(':')[0]
+
+        def uncached():
+            module, sep, attr = implementation.rpartition('.')
+            return getattr(__import__(module, fromlist=(attr,)), attr)
+
+        def cached():
+            return util.reference_model(implementation)
+
+        self.assertTrue(uncached() is Ref)
+        self.assertTrue(cached() is Ref)
+        before = min(timeit.repeat(uncached, number=10000, repeat=3)) / 10000
+        after = min(timeit.repeat(cached, number=10000, repeat=3)) / 10000
+        # timings are only reported, they vary too much to assert on
+        sys.stderr.write('\nreference class resolution: %.3fus before, %.3fus after\n' % (before * 1e6, after * 1e6))
+
+        util.clear_reference_cache()
+        self.assertTrue(cached() is Ref)
+
     def test_empty_querying(self):
         RefsBag.objects.create(name='bag')
         self.assertTrue(RefsBag.objects.get(refs={}))